@@ -0,0 +1,125 @@
+'''
+Throughput and latency benchmark suite.
+
+Generates the synthetic workloads in benchmarks.workload, replays them
+in-process against a TransactionManager and reports operations per second,
+commit and abort rates and per operation latency percentiles. Every run is
+appended as one JSON line to the output file so results can be tracked over time.
+
+    python3 -m benchmarks.bench                              # all scenarios
+    python3 -m benchmarks.bench --scenario hot-keys --transactions 5000
+    python3 -m benchmarks.bench --emit traces/               # also write the workloads as traces
+'''
+
+import argparse
+import json
+import os
+import platform
+import time
+from collections import defaultdict
+from typing import Dict, List
+from tabulate import tabulate
+from benchmarks.workload import Workload, SCENARIOS
+from parser.operations import Operations
+from sites.storage import STORAGE_ENGINES
+from sites.topology import Topology
+from transaction_handling.transactionManager import TransactionManager
+from transaction_handling.sinks import NullSink
+
+
+def percentile(sorted_values: List[int], fraction: float) -> float:
+    """Nearest rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def _latency_summary(latencies_ns: List[int]) -> Dict[str, float]:
+    latencies_ns = sorted(latencies_ns)
+    return {
+        "count": len(latencies_ns),
+        "p50_us": percentile(latencies_ns, 0.50) / 1000,
+        "p99_us": percentile(latencies_ns, 0.99) / 1000,
+    }
+
+
+def run_benchmark(workload: Workload, storage: str = 'object', group_commit: int = 0) -> dict:
+    """
+    Replays a workload against a fresh transaction manager and returns the results.
+    Operations are parsed up front, only the time spent in the engine is measured.
+    """
+    operations = [Operations.parse(line) for line in workload.operations()]
+    transaction_manager = TransactionManager(Topology(workload.num_sites, workload.num_variables),
+                                             storage=storage, sink=NullSink(), group_commit=group_commit)
+    latencies = defaultdict(list)
+    started = time.perf_counter()
+    for operation in operations:
+        operation_started = time.perf_counter_ns()
+        transaction_manager.processOperation(operation, False)
+        latencies[operation.op_type].append(time.perf_counter_ns() - operation_started)
+    transaction_manager.flush_commits()
+    elapsed = time.perf_counter() - started
+    committed = transaction_manager.metrics.commits
+    aborted = transaction_manager.metrics.aborted
+    finished = max(committed + aborted, 1)
+    return {
+        "operations": len(operations),
+        "seconds": elapsed,
+        "ops_per_sec": len(operations) / elapsed if elapsed else 0.0,
+        "committed": committed,
+        "aborted": aborted,
+        "commit_rate": committed / finished,
+        "abort_rate": aborted / finished,
+        "latency": _latency_summary([value for values in latencies.values() for value in values]),
+        "latency_by_operation": {op_type: _latency_summary(values) for op_type, values in latencies.items()},
+        "aborts": dict(transaction_manager.metrics.aborts),
+    }
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="Run the synthetic workload benchmarks.")
+    arg_parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                            help="scenario to run, may be repeated (default: all)")
+    arg_parser.add_argument("--transactions", type=int, default=2000, help="transactions per scenario")
+    arg_parser.add_argument("--sites", type=int, default=10, help="number of sites")
+    arg_parser.add_argument("--variables", type=int, default=20, help="number of variables")
+    arg_parser.add_argument("--storage", choices=STORAGE_ENGINES, default="object", help="storage engine")
+    arg_parser.add_argument("--group-commit", type=int, default=0, metavar="N",
+                            help="commit up to N consecutive ends together (default 0, off)")
+    arg_parser.add_argument("--seed", type=int, default=0, help="random seed of the workloads")
+    arg_parser.add_argument("--output", default="bench_results.jsonl",
+                            help="JSON lines file the results are appended to")
+    arg_parser.add_argument("--emit", help="directory to also write every workload to as a trace")
+    return arg_parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rows = []
+    for name in args.scenario or sorted(SCENARIOS):
+        workload = Workload(transactions=args.transactions, num_sites=args.sites,
+                            num_variables=args.variables, seed=args.seed, **SCENARIOS[name])
+        if args.emit:
+            os.makedirs(args.emit, exist_ok=True)
+            with open(os.path.join(args.emit, "%s.txt" % name), "w") as trace:
+                trace.write("\n".join(workload.operations()))
+        result = run_benchmark(workload, args.storage, args.group_commit)
+        record = {
+            "scenario": name,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "storage": args.storage,
+            "group_commit": args.group_commit,
+            "workload": workload.parameters(),
+            "results": result,
+        }
+        with open(args.output, "a") as output:
+            output.write(json.dumps(record) + "\n")
+        rows.append([name, result["operations"], "%.0f" % result["ops_per_sec"],
+                     "%.1f%%" % (100 * result["commit_rate"]), "%.1f%%" % (100 * result["abort_rate"]),
+                     "%.1f" % result["latency"]["p50_us"], "%.1f" % result["latency"]["p99_us"]])
+    print(tabulate(rows, headers=["scenario", "ops", "ops/sec", "commits", "aborts", "p50 us", "p99 us"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''
+Load test of the network front-end: many simulated clients, each replaying its own
+synthetic workload over one connection with every operation pipelined.
+
+    python3 -m benchmarks.load --clients 50 --transactions 200
+    python3 -m benchmarks.load --connect 127.0.0.1:7878
+'''
+
+import argparse
+import asyncio
+import time
+from tabulate import tabulate
+from benchmarks.workload import Workload, SCENARIOS
+from server import Server
+from sites.topology import Topology
+from transaction_handling.sinks import NullSink
+from transaction_handling.transactionManager import TransactionManager
+
+
+async def run_client(host: str, port: int, workload: Workload) -> dict:
+    """Send a whole workload at once, then read the results until the server says Bye!."""
+    reader, writer = await asyncio.open_connection(host, port)
+    lines = list(workload.operations())
+    started = time.perf_counter()
+    writer.write(("\n".join(lines) + "\nexit\n").encode('utf-8'))
+    await writer.drain()
+    committed = aborted = 0
+    while True:
+        line = await reader.readline()
+        if not line or line == b"Bye!\n":
+            break
+        if line.startswith(b"Transaction committed"):
+            committed += 1
+        elif line.startswith(b"Aborted"):
+            aborted += 1
+    elapsed = time.perf_counter() - started
+    writer.close()
+    return {"operations": len(lines), "seconds": elapsed, "committed": committed, "aborted": aborted}
+
+
+async def run_load(args) -> list:
+    listener = None
+    host, port = args.host, args.port
+    if args.connect is None:
+        # serve in-process on an ephemeral port
+        transaction_manager = TransactionManager(Topology(args.sites, args.variables), sink=NullSink())
+        server = Server(transaction_manager, args.batch_size)
+        dispatcher = asyncio.create_task(server.dispatch())
+        listener = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+        host, port = listener.sockets[0].getsockname()[:2]
+    else:
+        host, _, port = args.connect.rpartition(':')
+        port = int(port)
+    parameters = dict(SCENARIOS[args.scenario], failure_rate=0.0)
+    workloads = [Workload(transactions=args.transactions, num_sites=args.sites, num_variables=args.variables,
+                          seed=args.seed + client, **parameters) for client in range(args.clients)]
+    try:
+        return await asyncio.gather(*(run_client(host, port, workload) for workload in workloads))
+    finally:
+        if listener is not None:
+            dispatcher.cancel()
+            listener.close()
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="Load test the network front-end with simulated clients.")
+    arg_parser.add_argument("--connect", metavar="HOST:PORT", help="server to load, by default one is started in-process")
+    arg_parser.add_argument("--clients", type=int, default=20, help="number of concurrent clients")
+    arg_parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="read-heavy",
+                            help="workload of every client, without site failures")
+    arg_parser.add_argument("--transactions", type=int, default=100, help="transactions per client")
+    arg_parser.add_argument("--sites", type=int, default=10, help="number of sites")
+    arg_parser.add_argument("--variables", type=int, default=20, help="number of variables")
+    arg_parser.add_argument("--batch-size", type=int, default=256, help="dispatcher batch size of the in-process server")
+    arg_parser.add_argument("--seed", type=int, default=0, help="random seed of the first client")
+    arg_parser.set_defaults(host=None, port=None)
+    return arg_parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    started = time.perf_counter()
+    results = asyncio.run(run_load(args))
+    elapsed = time.perf_counter() - started
+    operations = sum(result["operations"] for result in results)
+    committed = sum(result["committed"] for result in results)
+    aborted = sum(result["aborted"] for result in results)
+    print(tabulate([[len(results), operations, "%.0f" % (operations / elapsed), committed, aborted,
+                     "%.2f" % max(result["seconds"] for result in results)]],
+                   headers=["clients", "ops", "ops/sec", "commits", "aborts", "slowest client s"]))
+
+
+if __name__ == '__main__':
+    main()
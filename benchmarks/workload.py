@@ -0,0 +1,91 @@
+'''
+Synthetic workload generator emitting the operation language.
+'''
+
+import random
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Iterator, List
+
+
+class Workload:
+    """
+    Parameters of a synthetic workload.
+
+    read_ratio: fraction of the operations inside a transaction that are reads
+    skew: Zipfian skew of the variable accessed, 0 is uniform, around 1 is hot keys
+    transaction_length: number of reads and writes per transaction
+    concurrency: number of transactions kept open at the same time
+    failure_rate: probability that a site fails or recovers before an operation
+    transactions: total number of transactions to run
+    """
+
+    def __init__(self, transactions: int = 1000, read_ratio: float = 0.5, skew: float = 0.0,
+                 transaction_length: int = 4, concurrency: int = 4, failure_rate: float = 0.0,
+                 num_sites: int = 10, num_variables: int = 20, seed: int = 0):
+        self.transactions = transactions
+        self.read_ratio = read_ratio
+        self.skew = skew
+        self.transaction_length = transaction_length
+        self.concurrency = concurrency
+        self.failure_rate = failure_rate
+        self.num_sites = num_sites
+        self.num_variables = num_variables
+        self.seed = seed
+
+    def parameters(self):
+        """The parameters as a dictionary, for reports."""
+        return dict(vars(self))
+
+    def _zipf_cdf(self) -> List[float]:
+        weights = [1.0 / (rank ** self.skew) for rank in range(1, self.num_variables + 1)]
+        return list(accumulate(weights))
+
+    def operations(self) -> Iterator[str]:
+        """Generates the workload as lines of the operation language."""
+        rng = random.Random(self.seed)
+        cdf = self._zipf_cdf()
+        total = cdf[-1]
+        # hot keys are spread over the variables instead of always being x1, x2, ...
+        ranking = list(range(1, self.num_variables + 1))
+        rng.shuffle(ranking)
+        down = []
+        active = {}  # transaction id -> operations left
+        begun = 0
+        while begun < self.transactions or active:
+            if rng.random() < self.failure_rate:
+                if down and (len(down) == self.num_sites or rng.random() < 0.5):
+                    yield "recover(%i)" % down.pop(rng.randrange(len(down)))
+                else:
+                    site_id = rng.choice([site for site in range(1, self.num_sites + 1) if site not in down])
+                    down.append(site_id)
+                    yield "fail(%i)" % site_id
+            if len(active) < self.concurrency and begun < self.transactions:
+                begun += 1
+                transaction_id = "T%i" % begun
+                active[transaction_id] = self.transaction_length
+                yield "begin(%s)" % transaction_id
+                continue
+            transaction_id = rng.choice(list(active))
+            if active[transaction_id] == 0:
+                del active[transaction_id]
+                yield "end(%s)" % transaction_id
+                continue
+            active[transaction_id] -= 1
+            variable = "x%i" % ranking[bisect_left(cdf, rng.random() * total)]
+            if rng.random() < self.read_ratio:
+                yield "R(%s,%s)" % (transaction_id, variable)
+            else:
+                yield "W(%s,%s,%i)" % (transaction_id, variable, rng.randrange(1000))
+        for site_id in down:
+            yield "recover(%i)" % site_id
+
+
+SCENARIOS = {
+    "read-heavy": dict(read_ratio=0.9),
+    "write-heavy": dict(read_ratio=0.1),
+    "hot-keys": dict(read_ratio=0.5, skew=1.2),
+    "long-transactions": dict(transaction_length=16),
+    "high-concurrency": dict(concurrency=32),
+    "failures": dict(failure_rate=0.02),
+}
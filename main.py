@@ -1,18 +1,87 @@
+import argparse
+import itertools
+import os
+import sys
 from parser.parser import Parser
 from transaction_handling.transaction import Transaction
 from transaction_handling.transactionManager import TransactionManager
 from sites.site_object import Site
+from sites.storage import STORAGE_ENGINES
+from sites.topology import Topology
+from transaction_handling.sinks import SINKS
+from transaction_handling.state import load_state, save_state
+
+def parse_args():
+    """Command line options, everything that is not an option is read as an input file."""
+    arg_parser = argparse.ArgumentParser(description="Replicated concurrency control and recovery database.")
+    arg_parser.add_argument("files", nargs="*", help="files with operations, stdin is read if none are given")
+    arg_parser.add_argument("--sites", type=int, default=10, help="number of sites (default 10)")
+    arg_parser.add_argument("--variables", type=int, default=20, help="number of variables (default 20)")
+    arg_parser.add_argument("--storage", choices=STORAGE_ENGINES, default="object",
+                            help="storage engine, columnar needs numpy (default object)")
+    arg_parser.add_argument("--output", choices=sorted(SINKS), default="text",
+                            help="text as printed so far, jsonl for one JSON object per event or none (default text)")
+    arg_parser.add_argument("--catch-up", type=int, default=0, metavar="N",
+                            help="recovered sites copy up to N replicated variables per operation from a current "
+                                 "replica (default 0, off)")
+    arg_parser.add_argument("--workers", type=int, default=0, metavar="N",
+                            help="thread safe mode validating commits at the sites on N worker threads (default 0, off)")
+    arg_parser.add_argument("--processes", type=int, default=0, metavar="N",
+                            help="run the sites in N worker processes committing with two phases (default 0, off)")
+    arg_parser.add_argument("--group-commit", type=int, default=0, metavar="N",
+                            help="validate and commit up to N consecutive ends together (default 0, off)")
+    arg_parser.add_argument("--wal", metavar="DIR",
+                            help="log committed writes to DIR and recover the data committed there by earlier runs")
+    arg_parser.add_argument("--resume", metavar="FILE",
+                            help="continue from a saved state, skipping the operations it already processed")
+    arg_parser.add_argument("--save-every", type=int, default=0, metavar="N",
+                            help="save the state every N operations (default 0, off)")
+    arg_parser.add_argument("--save-at", type=int, action="append", default=[], metavar="TICK",
+                            help="save the state after the operation at TICK, may be repeated")
+    arg_parser.add_argument("--state-dir", default="states", metavar="DIR",
+                            help="directory of the saved states, one tick<N>.state per save (default states)")
+    args = arg_parser.parse_args()
+    if (args.save_every or args.save_at) and args.processes:
+        arg_parser.error("states cannot be saved with --processes")
+    if args.resume and (args.wal or args.processes):
+        arg_parser.error("--resume cannot be combined with --wal or --processes")
+    return args
 
 def main():
     """The main control loop that reads every operations and processes it."""
     
+    args = parse_args()
     parser = Parser()
-    transaction_manager = TransactionManager()
+    sink = SINKS[args.output]()
+    interactive = not args.files and sys.stdin.isatty()
+    if interactive:
+        sink.batch_size = 1  # answer every command of an interactive session right away
+    if args.resume:
+        transaction_manager = load_state(args.resume, sink)
+    else:
+        transaction_manager = TransactionManager(Topology(args.sites, args.variables), storage=args.storage, sink=sink,
+                                                 wal_dir=args.wal, group_size=1 if interactive else 32,
+                                                 catch_up_rate=args.catch_up,
+                                                 workers=args.workers, processes=args.processes,
+                                                 group_commit=args.group_commit)
+    save_at = set(args.save_at)
+    operations = parser.run(args.files)
+    if args.resume:
+        # a resumed manager already processed the first ticker operations of the input,
+        # the ticker of a manager recovered from --wal only continues the logged one
+        operations = itertools.islice(operations, transaction_manager.ticker, None)
     
-    for operation in parser.run():
-        transaction_manager.processOperation(operation, False)
+    try:
+        for operation in operations:
+            transaction_manager.processOperation(operation, False)
+            tick = transaction_manager.ticker
+            if (args.save_every and tick % args.save_every == 0) or tick in save_at:
+                transaction_manager.sink.flush()
+                save_state(transaction_manager, os.path.join(args.state_dir, "tick%i.state" % tick))
+    finally:
+        transaction_manager.close()
 
 
 
 if __name__=='__main__':
-    main()
\ No newline at end of file
+    main()
@@ -2,52 +2,77 @@
 author: Sarthak Khandelwal
 '''
 
-import re
+from typing import Union
 
-
-VALID_OPERATIONS = ['begin', 'r', 'w', 'dump', 'end', 'fail', 'recover']
+VALID_OPERATIONS = ['begin', 'r', 'w', 'dump', 'end', 'fail', 'recover', 'querystate']
+INVALID_OPERATION = 'invalid'
+_VALID_OPERATIONS = frozenset(VALID_OPERATIONS)
 
 class Operations:
     """
     The operation class that represents operations for all transactions. Every line
-    entered on the stdin is parsed as a operation object and processed. 
+    entered on the stdin is parsed as a operation object and processed. Operations
+    are compact records: only the fields an operation type uses are set, the
+    others are None.
     """
 
-    def __init__(self, raw_str):
+    __slots__ = ('op_type', 'id', 'variable', 'value')
+
+    def __init__(self, op_type: str, id: str = None, variable: str = None, value: Union[int, str] = None):
+        self.op_type = op_type
+        self.id = id
+        self.variable = variable
+        self.value = value
+
+    @classmethod
+    def parse(cls, raw_str: str) -> "Operations":
         """
-        Checks if a raw string is a valid operation and parses it.
+        Checks if a raw string is a valid operation and parses it in a single pass.
         Operations supported:
         
         begin(T1) : starts a new transaction with id T1. Id can be any string.
         R(T1,x1): read x1 in transaction T1
         W(T1, x1, 10): write x1 to 10 in transaction T1
         dump(): dump all values at all sites in the database
+        dump(csv, sites=1-3, vars=x2-x8, changed): dump as csv or jsonl, only some sites or
+            variables, or only what changed since the last dump, see TransactionManager.dump
         end(T1): end/try to commit transaction T1
         fail(1): fail site 1
         recover(1): recover site 1
-        
+        querystate(): print the metrics of the database, querystate(json) prints them as JSON
+
+        `exit` is returned as an operation of type exit, it is up to the caller to stop.
+        Anything else is returned as an invalid operation, which the transaction
+        manager reports when it is processed.
         """
-        self._raw_str = raw_str.lower()
-        self.op_type = self._raw_str.split('(')[0]
-        if self.op_type == 'exit':
-            print('Bye!')
-            exit()
-        if self.op_type not in VALID_OPERATIONS:
-            print("Not a valid operation!")
-        else:
-            op_values_search = re.search(r'\((.*?)\)', self._raw_str)
-            op_values = op_values_search.group(1).split(',')
-            if self.op_type == 'begin' or  self.op_type == 'end' \
-                or  self.op_type == 'recover' or  self.op_type == 'fail':
-                self.id = op_values[0].strip()
-            elif self.op_type == 'r':
-                self.id = op_values[0].strip()
-                self.variable = op_values[1].strip()
-            elif self.op_type == 'w':
-                self.id = op_values[0].strip()
-                self.variable = op_values[1].strip()
-                self.value = op_values[2].strip()
-            elif self.op_type == 'end':
-                self.id =  op_values[0].strip()
-            elif self.op_type == 'fail':
-                self.id = op_values[0].strip()
+        op_type, opened, rest = raw_str.lower().partition('(')
+        if op_type == 'exit':
+            return cls(op_type)
+        op_values, closed, _ = rest.partition(')')
+        if op_type not in _VALID_OPERATIONS or not closed:
+            return cls(INVALID_OPERATION)
+        if op_type == 'dump':
+            return cls(op_type, op_values.replace(' ', '') or None)
+        op_values = op_values.split(',')
+        if op_type == 'r' and len(op_values) >= 2:
+            return cls(op_type, op_values[0].strip(), op_values[1].strip())
+        if op_type == 'w' and len(op_values) >= 3:
+            return cls(op_type, op_values[0].strip(), op_values[1].strip(), _value(op_values[2].strip()))
+        if op_type != 'r' and op_type != 'w':
+            return cls(op_type, op_values[0].strip())
+        return cls(INVALID_OPERATION)
+
+    def __repr__(self):
+        return "Operations(%r, %r, %r, %r)" % (self.op_type, self.id, self.variable, self.value)
+
+
+def _value(raw: str):
+    """
+    A written value, as an int when it is written as one, so it is reported like
+    the initial values. Anything else, "007" included, is kept as written.
+    """
+    try:
+        value = int(raw)
+    except ValueError:
+        return raw
+    return value if str(value) == raw else raw
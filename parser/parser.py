@@ -3,12 +3,40 @@ author: Sarthak Khandelwal
 '''
 
 import fileinput
+import sys
 from parser.operations import Operations
+from parser.trace import is_trace, read_trace
 
 class Parser:
     
-    def run(self):
-        """Reads commands line by line from a input file to stdin and created a operation object."""
-        for line in fileinput.input():
-            operation = Operations(line.strip())
-            yield operation
\ No newline at end of file
+    def run(self, files=None):
+        """
+        Reads commands line by line from the given input files, or stdin if there are
+        none, and creates a operation object for each. Compiled binary traces are
+        streamed from a memory mapped file instead. Stops after yielding an exit operation.
+        """
+        files = list(files if files is not None else sys.argv[1:]) or ['-']
+        for path in files:
+            if path != '-' and is_trace(path):
+                operations = read_trace(path)
+            else:
+                operations = self._read_text(path)
+            try:
+                for operation in operations:
+                    yield operation
+                    if operation.op_type == 'exit':
+                        return
+            finally:
+                operations.close()
+
+    def _read_text(self, path):
+        """Tokenizes the lines of a text file, or stdin for '-', one operation per line."""
+        if path == '-':
+            with fileinput.FileInput(files=[path]) as lines:
+                for line in lines:
+                    yield Operations.parse(line.strip())
+            return
+        parse = Operations.parse
+        with open(path) as lines:
+            for line in lines:
+                yield parse(line.strip())
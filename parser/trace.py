@@ -0,0 +1,126 @@
+'''
+Compiled binary traces.
+
+A trace is a header, a sequence of fixed size operation records and a table of
+interned strings (transaction ids, variables, site ids). Records refer to
+strings by their index in the table, so a trace can be streamed straight from a
+memory mapped file without tokenizing any text.
+
+    header:  magic, format version, record count, string table offset
+    record:  operation code, id index, variable index, value
+    strings: count, then length prefixed utf-8 strings
+
+Compile a text trace with:
+
+    python3 -m parser.trace tests/test01.txt test01.trace
+'''
+
+import fileinput
+import mmap
+import struct
+import sys
+from typing import Dict, Iterable, Iterator, List
+from parser.operations import Operations, INVALID_OPERATION
+
+MAGIC = b'RPCT'
+VERSION = 1
+HEADER = struct.Struct('<4sHQQ')
+RECORD = struct.Struct('<BIIq')
+STRING_LENGTH = struct.Struct('<I')
+NO_STRING = 0xFFFFFFFF
+# the position of an operation in this list is its code in the file, only append to it
+OPERATION_CODES = ['begin', 'r', 'w', 'dump', 'end', 'fail', 'recover', INVALID_OPERATION, 'exit', 'querystate']
+
+
+class TraceFormatError(Exception):
+    """Raised when a file is not a compiled trace this version can read."""
+
+
+def is_trace(path: str) -> bool:
+    """Checks if a file is a compiled binary trace."""
+    try:
+        with open(path, 'rb') as trace_file:
+            return trace_file.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def compile_trace(lines: Iterable[str], path: str) -> int:
+    """
+    Compiles operations given as text lines into a binary trace at path and
+    returns the number of records written. Values of writes must be integers
+    written as such, a value like 007 would not read back as written.
+    """
+    strings: Dict[str, int] = {}
+
+    def intern(string):
+        if string is None:
+            return NO_STRING
+        if string not in strings:
+            strings[string] = len(strings)
+        return strings[string]
+
+    count = 0
+    with open(path, 'wb') as trace_file:
+        trace_file.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        for line in lines:
+            operation = Operations.parse(line.strip())
+            value = 0
+            if operation.value is not None:
+                # parsing keeps values not written as a plain int, like 007, as strings
+                if not isinstance(operation.value, int):
+                    raise ValueError("Binary traces only support integer values, got %s" % operation.value)
+                value = operation.value
+            trace_file.write(RECORD.pack(OPERATION_CODES.index(operation.op_type), intern(operation.id),
+                                         intern(operation.variable), value))
+            count += 1
+        table_offset = trace_file.tell()
+        trace_file.write(STRING_LENGTH.pack(len(strings)))
+        for string in strings:
+            encoded = string.encode('utf-8')
+            trace_file.write(STRING_LENGTH.pack(len(encoded)))
+            trace_file.write(encoded)
+        trace_file.seek(0)
+        trace_file.write(HEADER.pack(MAGIC, VERSION, count, table_offset))
+    return count
+
+
+def _read_strings(buffer, offset: int) -> List[str]:
+    (count,) = STRING_LENGTH.unpack_from(buffer, offset)
+    offset += STRING_LENGTH.size
+    strings = []
+    for _ in range(count):
+        (length,) = STRING_LENGTH.unpack_from(buffer, offset)
+        offset += STRING_LENGTH.size
+        strings.append(bytes(buffer[offset:offset + length]).decode('utf-8'))
+        offset += length
+    return strings
+
+
+def read_trace(path: str) -> Iterator[Operations]:
+    """Streams the operations of a compiled binary trace from a memory mapped file."""
+    with open(path, 'rb') as trace_file, \
+            mmap.mmap(trace_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        magic, version, count, table_offset = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise TraceFormatError("%s is not a version %i trace" % (path, VERSION))
+        strings = _read_strings(buffer, table_offset)
+        strings.append(None)  # NO_STRING is looked up as the last entry
+        no_string = len(strings) - 1
+        records = memoryview(buffer)[HEADER.size:HEADER.size + count * RECORD.size]
+        try:
+            for code, id_index, variable_index, value in RECORD.iter_unpack(records):
+                op_type = OPERATION_CODES[code]
+                yield Operations(op_type,
+                                 strings[no_string if id_index == NO_STRING else id_index],
+                                 strings[no_string if variable_index == NO_STRING else variable_index],
+                                 value if op_type == 'w' else None)
+        finally:
+            records.release()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("usage: python3 -m parser.trace <text trace> <binary trace>")
+        sys.exit(2)
+    print("Compiled %i operations" % compile_trace(fileinput.input(files=[sys.argv[1]]), sys.argv[2]))
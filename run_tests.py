@@ -0,0 +1,173 @@
+'''
+Runs trace files in-process on a pool of worker processes.
+
+Every trace is replayed against its own TransactionManager and its output is
+captured. Without a golden reference the outputs are printed in the same
+format as the old run_tests.sh. With one, every trace is compared against its
+expected output and a summary is printed.
+
+    python3 run_tests.py                                    # all tests/test*.txt
+    python3 run_tests.py --golden all_tests_output.txt      # compare to the golden file
+    python3 run_tests.py generated/*.txt --golden expected/ # golden directory, one <trace>.out per trace
+    python3 run_tests.py tests/catch_up/*.txt --catch-up 5 --golden tests/catch_up/
+    python3 run_tests.py --workers 4 --golden all_tests_output.txt  # same output in every execution mode
+'''
+
+import argparse
+import glob
+import io
+import os
+import re
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from parser.parser import Parser
+from sites.storage import STORAGE_ENGINES
+from sites.topology import Topology
+from transaction_handling.transactionManager import TransactionManager
+from transaction_handling.sinks import StdoutSink
+
+TEST_FOLDER = "tests"
+SECTION_START = re.compile(r'^\*{12} TEST (.+) \*{12}$')
+SECTION_END = "************ END OF TEST %s ************"
+
+
+def section_name(path: str) -> str:
+    """Name of a trace in the combined output, the test number for tests/testNN.txt."""
+    match = re.fullmatch(r'test([0-9]+)\.txt', os.path.basename(path))
+    return match.group(1) if match else os.path.basename(path)
+
+
+def run_trace(path: str, sites: int = 10, variables: int = 20, storage: str = 'object', catch_up: int = 0,
+              workers: int = 0, processes: int = 0, group_commit: int = 0):
+    """Replays one trace against a fresh transaction manager and returns its output."""
+    output = io.StringIO()
+    sink = StdoutSink(stream=output)
+    try:
+        transaction_manager = TransactionManager(Topology(sites, variables), storage=storage, sink=sink,
+                                                 catch_up_rate=catch_up, workers=workers, processes=processes,
+                                                 group_commit=group_commit)
+        try:
+            for operation in Parser().run([path]):
+                transaction_manager.processOperation(operation, False)
+        finally:
+            # commits the ends still waiting in a group commit and stops the workers
+            transaction_manager.close()
+    except Exception:
+        sink.flush()
+        traceback.print_exc(file=output)
+    sink.flush()
+    return output.getvalue()
+
+
+def _run_trace(job):
+    return run_trace(*job)
+
+
+def run_traces(paths, jobs=None, sites=10, variables=20, storage='object', catch_up=0, workers=0, processes=0,
+               group_commit=0):
+    """Runs the traces on a process pool and returns their outputs, in the order given."""
+    work = [(path, sites, variables, storage, catch_up, workers, processes, group_commit) for path in paths]
+    if jobs == 1 or len(work) <= 1:
+        return [_run_trace(job) for job in work]
+    workers = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_run_trace, work, chunksize=max(1, len(work) // (workers * 4))))
+
+
+def load_golden(path: str, paths):
+    """
+    Loads the expected output of every trace, either from a combined file in the
+    format printed by this runner or from a directory with one <trace>.out per trace.
+    """
+    if os.path.isdir(path):
+        expected = {}
+        for trace in paths:
+            golden_file = os.path.join(path, os.path.basename(trace) + ".out")
+            if os.path.exists(golden_file):
+                with open(golden_file) as golden:
+                    expected[trace] = golden.read()
+        return expected
+    sections = {}
+    name, lines = None, []
+    with open(path) as golden:
+        for line in golden:
+            match = SECTION_START.match(line.rstrip('\n'))
+            if name is None and match:
+                name, lines = match.group(1), []
+            elif name is not None and line.rstrip('\n') == SECTION_END % name:
+                sections[name] = "".join(lines)
+                name = None
+            elif name is not None:
+                lines.append(line)
+    return {trace: sections[section_name(trace)] for trace in paths if section_name(trace) in sections}
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="Run trace files in-process on a pool of workers.")
+    arg_parser.add_argument("traces", nargs="*", help="trace files, all of tests/test*.txt by default")
+    arg_parser.add_argument("--golden", help="golden output file or directory to compare against")
+    arg_parser.add_argument("--output-dir", help="also write the output of every trace to <dir>/<trace>.out")
+    arg_parser.add_argument("--jobs", type=int, default=None, help="worker processes (default: cpu count)")
+    arg_parser.add_argument("--sites", type=int, default=10, help="number of sites (default 10)")
+    arg_parser.add_argument("--variables", type=int, default=20, help="number of variables (default 20)")
+    arg_parser.add_argument("--storage", choices=STORAGE_ENGINES, default="object", help="storage engine")
+    arg_parser.add_argument("--catch-up", type=int, default=0,
+                            help="replicated variables recovered sites copy per operation (default 0, off)")
+    arg_parser.add_argument("--workers", type=int, default=0, metavar="N",
+                            help="replay every trace in the thread safe mode with N worker threads (default 0, off)")
+    arg_parser.add_argument("--processes", type=int, default=0, metavar="N",
+                            help="replay every trace with its sites in N worker processes (default 0, off)")
+    arg_parser.add_argument("--group-commit", type=int, default=0, metavar="N",
+                            help="replay every trace committing up to N consecutive ends together (default 0, off)")
+    args = arg_parser.parse_args()
+    if args.group_commit and args.workers:
+        arg_parser.error("--group-commit cannot be combined with --workers")
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.traces:
+        paths = args.traces
+    else:
+        if not os.path.isdir(TEST_FOLDER):
+            print("Error: Folder '%s' does not exist." % TEST_FOLDER)
+            return 1
+        paths = sorted(glob.glob(os.path.join(TEST_FOLDER, "test*.txt")))
+    outputs = run_traces(paths, args.jobs, args.sites, args.variables, args.storage, args.catch_up, args.workers,
+                         args.processes, args.group_commit)
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for path, output in zip(paths, outputs):
+            with open(os.path.join(args.output_dir, os.path.basename(path) + ".out"), "w") as out_file:
+                out_file.write(output)
+
+    if args.golden is None:
+        for path, output in zip(paths, outputs):
+            name = section_name(path)
+            print("************ TEST %s ************" % name)
+            sys.stdout.write(output)
+            print(SECTION_END % name)
+            print()
+        print("All tests completed.")
+        return 0
+
+    expected = load_golden(args.golden, paths)
+    failed, missing = [], []
+    for path, output in zip(paths, outputs):
+        if path not in expected:
+            missing.append(path)
+        elif expected[path] != output:
+            failed.append(path)
+            print("FAILED %s" % path)
+    for path in missing:
+        print("NO GOLDEN OUTPUT %s" % path)
+    print("%i passed, %i failed, %i without golden output" % (len(paths) - len(failed) - len(missing),
+                                                              len(failed), len(missing)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
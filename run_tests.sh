@@ -1,25 +1,9 @@
 #!/bin/bash
 
-# Path to the tests folder
-TEST_FOLDER="tests"
+# Runs all test files in the tests folder in-process on a pool of workers
+# and prints their output, see run_tests.py. Extra arguments are passed on,
+# e.g. to compare against the expected output:
+#
+#   ./run_tests.sh --golden all_tests_output.txt
 
-# Check if the tests folder exists
-if [ ! -d "$TEST_FOLDER" ]; then
-  echo "Error: Folder '$TEST_FOLDER' does not exist."
-  exit 1
-fi
-
-# Loop through all test files in the folder
-for TEST_FILE in "$TEST_FOLDER"/test*.txt; do
-  if [ -f "$TEST_FILE" ]; then
-    # Extract the test number from the file name
-    TEST_NUMBER=$(basename "$TEST_FILE" | sed -E 's/test([0-9]+)\.txt/\1/')
-    
-    echo "************ TEST $TEST_NUMBER ************"
-    python3 main.py "$TEST_FILE"
-    echo "************ END OF TEST $TEST_NUMBER ************"
-    echo
-  fi
-done
-
-echo "All tests completed."
+exec python3 "$(dirname "$0")/run_tests.py" "$@"
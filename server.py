@@ -0,0 +1,203 @@
+'''
+Network front-end of the database: serves the operation language to many clients over
+TCP or a Unix socket, all sharing one transaction manager.
+'''
+
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+from typing import Dict, List, Set
+from parser.operations import Operations
+from sites.storage import STORAGE_ENGINES
+from sites.topology import Topology
+from transaction_handling import events
+from transaction_handling.sinks import NullSink
+from transaction_handling.transactionManager import TransactionManager
+
+# operations whose id is a transaction id, scoped to the session issuing them
+SESSION_OPERATIONS = frozenset(['begin', 'r', 'w', 'end'])
+
+
+class Session:
+    """A client connection. Its transaction ids are prefixed with the session id."""
+
+    def __init__(self, session_id: int, writer: asyncio.StreamWriter):
+        self.session_id = session_id
+        self.writer = writer
+        self.output: List[str] = []
+        self.closed = False
+        # scoped ids of the transactions the session began, aborted if it goes away
+        self.transactions: Set[str] = set()
+
+    def scope(self, transaction_id: str):
+        return "%i/%s" % (self.session_id, transaction_id)
+
+
+class Server:
+    """
+    Reads operations from every connection as they arrive, pipelined, and queues them.
+    A single dispatcher takes whatever is queued, up to batch_size operations, runs
+    the batch against the transaction manager and writes each result back to the
+    connection of the transaction it is about, or of the operation that caused it.
+    Results of a waiting operation that proceeds later thus reach the session that
+    issued it. Site operations (fail, recover, dump, querystate) act on the shared
+    database. An operation that raises is reported as an error to the session that
+    issued it. When a session closes, its unfinished transactions are aborted and
+    its waiting operations dropped.
+    """
+
+    def __init__(self, transaction_manager: TransactionManager, batch_size: int = 256, output: str = 'text'):
+        self.transaction_manager = transaction_manager
+        self.batch_size = batch_size
+        self.output = output
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.sessions: Dict[int, Session] = {}
+        self.session_ids = itertools.count(1)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Queue the operations of one client until it sends exit or disconnects."""
+        session = Session(next(self.session_ids), writer)
+        self.sessions[session.session_id] = session
+        operation = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').strip()
+                if not line:
+                    continue
+                operation = Operations.parse(line)
+                if operation.op_type == 'exit':
+                    break
+                if operation.op_type in SESSION_OPERATIONS:
+                    operation.id = session.scope(operation.id)
+                await self.queue.put((session, operation))
+        finally:
+            # closes the session once everything queued before has been answered
+            await self.queue.put((session, operation if operation is not None and operation.op_type == 'exit'
+                                  else None))
+
+    async def dispatch(self):
+        """Run queued operations against the transaction manager, one batch at a time."""
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            touched: Dict[int, Session] = {}
+            closing = []
+            for session, operation in batch:
+                touched[session.session_id] = session
+                if operation is None or operation.op_type == 'exit':
+                    # unfinished transactions of a closing session would hold back
+                    # garbage collection for everyone
+                    self._deliver(self.transaction_manager.abort(session.transactions), session, touched)
+                    session.transactions.clear()
+                    if operation is not None:
+                        session.output.append(self._format(events.Bye()))
+                    closing.append(session)
+                    continue
+                if operation.op_type == 'begin':
+                    session.transactions.add(operation.id)
+                try:
+                    operation_events = self.transaction_manager.processOperation(operation, False)
+                except Exception as error:
+                    # a failing operation must not stop the dispatcher of every session
+                    message = "%s: %s" % (type(error).__name__, error)
+                    session.output.append(self._format(events.OperationError(message)))
+                    continue
+                self._deliver(operation_events, session, touched)
+            if self.queue.empty():
+                # nothing else arrived, the commits held for a shared log sync are reported now
+                self._deliver(self.transaction_manager.sync_commits(), None, touched)
+            await self._flush(touched.values())
+            for session in closing:
+                session.closed = True
+                self.sessions.pop(session.session_id, None)
+                session.writer.close()
+
+    def _deliver(self, operation_events, issuer: Session, touched: Dict[int, Session]):
+        """Collect events for the sessions they are reported to."""
+        for event in operation_events:
+            target = self._route(event, issuer)
+            if target is not None and not target.closed:
+                target.output.append(self._format(self._unscoped(event)))
+                touched[target.session_id] = target
+
+    def _route(self, event: "events.Event", issuer: Session):
+        """The session an event is reported to."""
+        if isinstance(event, events.TransactionEvent):
+            prefix, scoped, _ = event.transaction_id.partition('/')
+            if scoped and prefix.isdigit():
+                return self.sessions.get(int(prefix))
+        return issuer
+
+    def _unscoped(self, event: "events.Event"):
+        """The event with the transaction id the client used."""
+        if isinstance(event, events.TransactionEvent) and '/' in event.transaction_id:
+            event = copy.copy(event)
+            event.transaction_id = event.transaction_id.partition('/')[2]
+        return event
+
+    def _format(self, event: "events.Event"):
+        if self.output == 'jsonl':
+            return json.dumps(event.to_dict()) + "\n"
+        return event.render() + "\n"
+
+    async def _flush(self, sessions):
+        """Write the output collected for the sessions, one write per session."""
+        writers = []
+        for session in sessions:
+            if session.output and not session.writer.is_closing():
+                session.writer.write("".join(session.output).encode('utf-8'))
+                writers.append(session.writer)
+            session.output = []
+        results = await asyncio.gather(*(writer.drain() for writer in writers), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, ConnectionError):
+                raise result
+
+
+async def serve(args):
+    transaction_manager = TransactionManager(Topology(args.sites, args.variables), storage=args.storage,
+                                             sink=NullSink(), wal_dir=args.wal, catch_up_rate=args.catch_up)
+    server = Server(transaction_manager, args.batch_size, args.output)
+    dispatcher = asyncio.create_task(server.dispatch())
+    if args.unix:
+        listener = await asyncio.start_unix_server(server.handle_connection, path=args.unix)
+    else:
+        listener = await asyncio.start_server(server.handle_connection, args.host, args.port)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        dispatcher.cancel()
+        transaction_manager.close()
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="Serve the database to many clients over the network.")
+    arg_parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default 127.0.0.1)")
+    arg_parser.add_argument("--port", type=int, default=7878, help="TCP port to listen on (default 7878)")
+    arg_parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead of TCP")
+    arg_parser.add_argument("--sites", type=int, default=10, help="number of sites (default 10)")
+    arg_parser.add_argument("--variables", type=int, default=20, help="number of variables (default 20)")
+    arg_parser.add_argument("--storage", choices=STORAGE_ENGINES, default="object",
+                            help="storage engine, columnar needs numpy (default object)")
+    arg_parser.add_argument("--output", choices=["text", "jsonl"], default="text",
+                            help="format of the results sent to the clients (default text)")
+    arg_parser.add_argument("--batch-size", type=int, default=256,
+                            help="most operations dispatched to the transaction manager at once (default 256)")
+    arg_parser.add_argument("--catch-up", type=int, default=0, metavar="N",
+                            help="replicated variables a recovered site catches up on per operation (default 0, off)")
+    arg_parser.add_argument("--wal", metavar="DIR", help="log committed writes to DIR and recover them from there")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
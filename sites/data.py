@@ -2,22 +2,55 @@
 author: Sarthak Khandelwal
 '''
 
+from bisect import bisect_left
+
 class Data:
-    """Data class for data present at each site. Each site has it's own copy of data objects."""
+    """
+    Data class for data present at each site. Each site has it's own copy of data objects.
+    Besides the current value, every data object keeps a chain of committed versions as
+    (commit tick, value) pairs, oldest first, so that snapshot reads can be answered for
+    any transaction that is still running.
+    """
 
     def __init__(self, variable_name: str, value: int):
         """Set a data object with a name and value."""
         self.variableName = variable_name
         self.value = value
         self.lastWriteTime = 0 
+        self.versions = [(0, value)]
 
     def setValue(self, new_value: int, tick: int):
         """Update a data object's value"""
         self.value = new_value
         self.lastWriteTime = tick  # Update timestamp -> we may need a global ticker or probably pass time in the parameters
+        if self.versions[-1][0] == tick:
+            self.versions[-1] = (tick, new_value)
+        else:
+            self.versions.append((tick, new_value))
 
     def getValue(self) -> int:
         """Get a data object's value"""
         return self.value
-    
 
+    def _version_at(self, tick: int):
+        """Returns the newest version committed strictly before tick."""
+        index = bisect_left(self.versions, (tick,))
+        return self.versions[max(index - 1, 0)]
+
+    def value_at(self, tick: int) -> int:
+        """Get the value a snapshot taken at tick would see."""
+        return self._version_at(tick)[1]
+
+    def last_write_time_at(self, tick: int) -> int:
+        """Get the last write time a snapshot taken at tick would see."""
+        return self._version_at(tick)[0]
+
+    def vacuum(self, horizon: int):
+        """
+        Drop versions no snapshot taken at or after horizon can see. The newest
+        version committed before horizon is kept along with everything after it.
+        """
+        index = bisect_left(self.versions, (horizon,))
+        if index > 1:
+            del self.versions[:index - 1]
+    
@@ -0,0 +1,376 @@
+'''
+Sites running in worker processes. Every worker owns a group of sites: their data,
+ssi_info and serialization graphs. The transaction manager talks to the workers over
+pipes through `SiteCluster`, `RemoteSite` and `RemoteStore` and commits with two
+phases, prepare (validate the serialization graphs) and commit or abort.
+'''
+
+import multiprocessing
+import os
+import signal
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List
+from sites.site_object import Site
+from sites.storage import ObjectStore, create_store, store_class
+from sites.topology import Topology
+from transaction_handling.transaction import Transaction
+
+
+class RemoteError(Exception):
+    """Raised when a site worker fails to handle a request."""
+
+
+def _transaction_copy(transaction: Transaction):
+    """What a site needs to know about a transaction: its id, times and read and write sets."""
+    copy = Transaction(transaction.id, transaction.start_time)
+    copy.commit_time = transaction.commit_time
+    copy.read_set, copy.write_set = transaction.get_read_write_sets()
+    return copy
+
+
+def _serve(connection, topology: Topology, site_ids: List[int], storage: str):
+    """Main loop of a site worker, answering requests until it is told to stop."""
+    store = ObjectStore(topology, site_ids) if storage == 'object' else create_store(storage, topology)
+    sites = {site_id: Site(True, -1, site_id, topology, store) for site_id in site_ids}
+
+    def prepare(site_ids, transaction, tick):
+        return [sites[site_id].updateGraph(transaction, tick) for site_id in site_ids]
+
+    def has_earlier_writer(site_ids, transaction):
+        return any(sites[site_id].has_earlier_writer(transaction) for site_id in site_ids)
+
+    def validate_batch(site_ids, transactions, ticks):
+        return [sites[site_id].validate_batch(transactions, ticks) for site_id in site_ids]
+
+    def commit(site_ids, commits, horizon):
+        for transaction_id, tick, _ in commits:
+            for site_id in site_ids:
+                transaction = sites[site_id].ssi_info.get(transaction_id)
+                if transaction is not None:
+                    transaction.commit_time = tick
+        site_writes = defaultdict(list)
+        for _, tick, writes_by_site in commits:
+            for site_id, writes in writes_by_site.items():
+                site_writes[site_id].extend((variable, value, tick) for variable, value in writes)
+        for site_id, writes in site_writes.items():
+            for variable, value, tick in writes:
+                sites[site_id].write_data(variable, value, tick, horizon)
+
+    def abort(site_ids, transaction_id):
+        for site_id in site_ids:
+            site = sites[site_id]
+            site.remove_aborted_transaction(site.ssi_info.get(transaction_id, Transaction(transaction_id, 0)))
+
+    def update_sets(transaction_id, read_write_sets):
+        for site in sites.values():
+            site.reindex_transaction(transaction_id, read_write_sets)
+
+    def site_data(site_id):
+        data = store.site_data(site_id)
+        return {variable: data[variable] for variable in data.keys()}
+
+    handlers = {
+        'prepare': prepare,
+        'has_earlier_writer': has_earlier_writer,
+        'validate_batch': validate_batch,
+        'commit': commit,
+        'abort': abort,
+        'update_sets': update_sets,
+        'remove_committed_transactions': lambda site_id, ids: sites[site_id].remove_committed_transactions(ids),
+        'reachable_from': lambda site_id, roots: sites[site_id].reachable_from(roots),
+        'gauges': lambda site_id: sites[site_id].gauges(),
+        'fail': lambda site_id, tick: sites[site_id].failSite(tick),
+        'recover': lambda site_id, last_down_time, tick: sites[site_id].recoverSite(last_down_time, tick),
+        'site_data': site_data,
+        'store': lambda method, args: getattr(store, method)(*args),
+    }
+    while True:
+        try:
+            name, args = connection.recv()
+        except EOFError:
+            break
+        if name == 'stop':
+            break
+        try:
+            connection.send((True, handlers[name](*args)))
+        except Exception as error:
+            connection.send((False, "%s: %s" % (type(error).__name__, error)))
+    connection.close()
+
+
+class SiteCluster:
+    """
+    The worker processes of the sites, sites are split over them in contiguous groups.
+    Requests to different workers are sent before any answer is awaited, so the
+    workers handle them in parallel. A worker whose sites are all down is paused
+    with SIGSTOP and resumed with SIGCONT when one of them recovers. Requests that
+    still need a paused worker, like dumping the stable storage of a failed site,
+    resume it for the duration of the request.
+    """
+
+    def __init__(self, topology: Topology, processes: int, storage: str = 'object'):
+        self.topology = topology
+        processes = max(1, min(processes, topology.num_sites))
+        size = -(-topology.num_sites // processes)
+        self.groups = [topology.site_ids[i:i + size] for i in range(0, topology.num_sites, size)]
+        self.worker_of: Dict[int, int] = {}
+        self.workers = []
+        self.connections = []
+        self.locks = []
+        self.paused = set()
+        self.down = set()
+        for worker, group in enumerate(self.groups):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve, args=(child, topology, group, storage), daemon=True)
+            process.start()
+            child.close()
+            self.workers.append(process)
+            self.connections.append(parent)
+            self.locks.append(threading.Lock())
+            for site_id in group:
+                self.worker_of[site_id] = worker
+        self.store = RemoteStore(self, storage)
+
+    def _send(self, worker: int, name: str, *args):
+        if worker in self.paused:
+            os.kill(self.workers[worker].pid, signal.SIGCONT)
+        self.connections[worker].send((name, args))
+
+    def _receive(self, worker: int):
+        ok, result = self.connections[worker].recv()
+        if worker in self.paused:
+            os.kill(self.workers[worker].pid, signal.SIGSTOP)
+        if not ok:
+            raise RemoteError(result)
+        return result
+
+    def call(self, site_id: int, name: str, *args):
+        """Send a request to the worker of a site and wait for its answer."""
+        worker = self.worker_of[site_id]
+        with self.locks[worker]:
+            self._send(worker, name, *args)
+            return self._receive(worker)
+
+    def call_workers(self, requests: Dict[int, tuple]):
+        """Send one request to each of several workers, then collect the answers by worker."""
+        workers = sorted(requests)
+        for worker in workers:
+            self.locks[worker].acquire()
+        try:
+            for worker in workers:
+                self._send(worker, *requests[worker])
+            return {worker: self._receive(worker) for worker in workers}
+        finally:
+            for worker in workers:
+                self.locks[worker].release()
+
+    def by_worker(self, site_ids: Iterable[int]):
+        """Groups site ids by the worker owning them, in order."""
+        groups = defaultdict(list)
+        for site_id in site_ids:
+            groups[self.worker_of[site_id]].append(site_id)
+        return groups
+
+    def prepare(self, site_ids: Iterable[int], transaction: Transaction, tick: int):
+        """First phase of a commit: validate it at every site, returns the votes in site order."""
+        copy = _transaction_copy(transaction)
+        groups = self.by_worker(site_ids)
+        answers = self.call_workers({worker: ('prepare', group, copy, tick) for worker, group in groups.items()})
+        votes = {}
+        for worker, group in groups.items():
+            votes.update(zip(group, answers[worker]))
+        return [votes[site_id] for site_id in site_ids]
+
+    def has_earlier_writer(self, site_ids: Iterable[int], transaction: Transaction):
+        """Checks at the sites, in parallel, if a transaction read a write committed before it started."""
+        copy = _transaction_copy(transaction)
+        groups = self.by_worker(site_ids)
+        answers = self.call_workers({worker: ('has_earlier_writer', group, copy) for worker, group in groups.items()})
+        return any(answers.values())
+
+    def validate_batch(self, site_ids: Iterable[int], transactions: List[Transaction], ticks: List[int]):
+        """
+        First phase of a group commit: validate the transactions in order at every site,
+        returns per site, in site order, the position of the first that failed or None.
+        """
+        copies = [_transaction_copy(transaction) for transaction in transactions]
+        groups = self.by_worker(site_ids)
+        answers = self.call_workers({worker: ('validate_batch', group, copies, ticks)
+                                     for worker, group in groups.items()})
+        results = {}
+        for worker, group in groups.items():
+            results.update(zip(group, answers[worker]))
+        return [results[site_id] for site_id in site_ids]
+
+    def commit(self, site_ids: Iterable[int], commits: List[tuple], horizon: int):
+        """
+        Second phase of one or more commits, given as (transaction id, tick, writes by
+        site): record the commit times at the sites and apply the writes in order.
+        """
+        groups = self.by_worker(site_ids)
+        for _, _, writes_by_site in commits:
+            for site_id in writes_by_site:
+                if site_id not in groups[self.worker_of[site_id]]:
+                    groups[self.worker_of[site_id]].append(site_id)
+        self.call_workers({worker: ('commit', group,
+                                    [(transaction_id, tick, {site_id: writes_by_site[site_id] for site_id in group
+                                                             if site_id in writes_by_site})
+                                     for transaction_id, tick, writes_by_site in commits],
+                                    horizon)
+                           for worker, group in groups.items()})
+
+    def abort(self, site_ids: Iterable[int], transaction_id: str):
+        """Second phase of an aborted commit: forget the transaction at the sites."""
+        groups = self.by_worker(site_ids)
+        self.call_workers({worker: ('abort', group, transaction_id) for worker, group in groups.items()})
+
+    def update_sets(self, transaction: Transaction):
+        """
+        Replace the read and write sets of the copies of a transaction at the running
+        workers and index them again.
+        """
+        read_write_sets = transaction.get_read_write_sets()
+        self.call_workers({worker: ('update_sets', transaction.id, read_write_sets)
+                           for worker in range(len(self.workers)) if worker not in self.paused})
+
+    def fail(self, site_id: int, tick: int):
+        """Fail a site, pausing its worker once all of the worker's sites are down."""
+        self.call(site_id, 'fail', site_id, tick)
+        self.down.add(site_id)
+        worker = self.worker_of[site_id]
+        if hasattr(signal, 'SIGSTOP') and all(other in self.down for other in self.groups[worker]):
+            with self.locks[worker]:
+                os.kill(self.workers[worker].pid, signal.SIGSTOP)
+                self.paused.add(worker)
+
+    def recover(self, site_id: int, last_down_time: int, tick: int):
+        """Recover a site, resuming its worker first."""
+        worker = self.worker_of[site_id]
+        with self.locks[worker]:
+            if worker in self.paused:
+                self.paused.discard(worker)
+                os.kill(self.workers[worker].pid, signal.SIGCONT)
+        self.down.discard(site_id)
+        self.call(site_id, 'recover', site_id, last_down_time, tick)
+
+    def close(self):
+        """Stop every worker."""
+        for worker, process in enumerate(self.workers):
+            if worker in self.paused:
+                os.kill(process.pid, signal.SIGCONT)
+            try:
+                self.connections[worker].send(('stop', ()))
+            except (BrokenPipeError, OSError):
+                pass
+        self.paused.clear()
+        for process in self.workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+class RemoteSite(Site):
+    """
+    A site whose data, ssi_info and serialization graph live in a worker process.
+    Its health and failure history are kept by the manager, like for a local site.
+    A site that is down has an empty ssi_info and graph, so removing transactions
+    from it is skipped.
+    """
+
+    def __init__(self, health: bool, last_down_time: int, site_id: int, cluster: SiteCluster):
+        super().__init__(health, last_down_time, site_id, cluster.topology, cluster.store)
+        self.cluster = cluster
+
+    @property
+    def data(self):
+        """Copy of the variable -> data mapping of the site."""
+        return self.cluster.call(self.site_id, 'site_data', self.site_id)
+
+    def updateGraph(self, transaction: Transaction, tick: int):
+        return self.cluster.prepare([self.site_id], transaction, tick)[0]
+
+    def has_earlier_writer(self, transaction: Transaction):
+        return self.cluster.has_earlier_writer([self.site_id], transaction)
+
+    def remove_aborted_transaction(self, transaction: Transaction):
+        if self.health:
+            self.cluster.abort([self.site_id], transaction.id)
+
+    def remove_committed_transactions(self, transaction_ids):
+        if self.health:
+            self.cluster.call(self.site_id, 'remove_committed_transactions', self.site_id, set(transaction_ids))
+
+    def reachable_from(self, roots):
+        if not self.health:
+            return set()
+        return self.cluster.call(self.site_id, 'reachable_from', self.site_id, list(roots))
+
+    def gauges(self):
+        return self.cluster.call(self.site_id, 'gauges', self.site_id)
+
+    def failSite(self, tick: int):
+        super().failSite(tick)
+        self.cluster.fail(self.site_id, tick)
+        return self.health
+
+    def recoverSite(self, lastdowntime: int, tick: int):
+        self.cluster.recover(self.site_id, lastdowntime, tick)
+        return super().recoverSite(lastdowntime, tick)
+
+
+class RemoteStore:
+    """Storage engine interface over the stores of the site workers."""
+
+    def __init__(self, cluster: SiteCluster, storage: str = 'object'):
+        self.cluster = cluster
+        self.topology = cluster.topology
+        # values are checked here, before they are sent to the workers
+        self.accepts = store_class(storage).accepts
+
+    def _call(self, site_id: int, method: str, *args):
+        return self.cluster.call(site_id, 'store', method, args)
+
+    def site_data(self, site_id: int):
+        return self.cluster.call(site_id, 'site_data', site_id)
+
+    def has(self, site_id: int, variable: str) -> bool:
+        return site_id in self.topology.sites_of(variable)
+
+    def value(self, site_id: int, variable: str):
+        return self._call(site_id, 'value', site_id, variable)
+
+    def last_write_time(self, site_id: int, variable: str) -> int:
+        return self._call(site_id, 'last_write_time', site_id, variable)
+
+    def value_at(self, site_id: int, variable: str, tick: int):
+        return self._call(site_id, 'value_at', site_id, variable, tick)
+
+    def last_write_time_at(self, site_id: int, variable: str, tick: int) -> int:
+        return self._call(site_id, 'last_write_time_at', site_id, variable, tick)
+
+    def write(self, site_id: int, variable: str, value, tick: int, horizon=None):
+        self._call(site_id, 'write', site_id, variable, value, tick, horizon)
+
+    def vacuum(self, site_ids: Iterable[int], variables: Iterable[str], horizon: int):
+        variables = list(variables)
+        groups = self.cluster.by_worker(site_ids)
+        self.cluster.call_workers({worker: ('store', 'vacuum', (group, variables, horizon))
+                                   for worker, group in groups.items()})
+
+    def any_write_after(self, site_ids: Iterable[int], variables: Iterable[str], tick: int) -> bool:
+        variables = list(variables)
+        groups = self.cluster.by_worker(site_ids)
+        answers = self.cluster.call_workers({worker: ('store', 'any_write_after', (group, variables, tick))
+                                             for worker, group in groups.items()})
+        return any(answers.values())
+
+    def table(self, site_ids: Iterable[int], variables: List[str]) -> List[list]:
+        site_ids = list(site_ids)
+        groups = self.cluster.by_worker(site_ids)
+        answers = self.cluster.call_workers({worker: ('store', 'table', (group, variables))
+                                             for worker, group in groups.items()})
+        rows = {}
+        for worker, group in groups.items():
+            rows.update(zip(group, answers[worker]))
+        return [rows[site_id] for site_id in site_ids]
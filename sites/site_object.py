@@ -2,89 +2,135 @@
 authors: Sarthak Khandelwal, Anand Trehan
 '''
 
-from sites.data import Data
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+from sites.storage import ObjectStore
+from sites.topology import Topology
 from transaction_handling.serialization import SerializationGraph
 from transaction_handling.transaction import Transaction
 
 class Site:
     """Site object representing each site in our database"""
 
-    def __init__(self, health: bool, last_down_time: int, site_id: int):
+    def __init__(self, health: bool, last_down_time: int, site_id: int, topology: Topology = None, store = None):
         self.health = health
         self.site_id = site_id # use this site_id to intialise data and graph  
-        self.data = self._initialise_data()  
+        self.topology = topology if topology is not None else Topology()
+        # storage engine holding the data, may be shared with the other sites
+        self.store = store if store is not None else ObjectStore(self.topology, [site_id])
         self.graph = self._initialise_graph()  
         self.last_down_time = last_down_time
+        # (tick, health, last_down_time) after every failure and recovery, oldest first
+        self.history = [(0, health, last_down_time)]
         self.ssi_info = {}
+        # variable -> ids of transactions in ssi_info that read / wrote it
+        self.readers = defaultdict(set)
+        self.writers = defaultdict(set)
+        # variable -> (tick, current) when replica catch-up made it current after a
+        # recovery, or a later commit to it skipped the site, oldest first
+        self.caught_up = defaultdict(list)
+        # held while the site is used by the concurrent mode of the transaction manager
+        self.lock = threading.RLock()
 
-    def _initialise_data(self):
-        """
-        Initialised a given site, with data. Even numbered variables are present at 
-        all sites whereas odd numbered ones are present at specific sites only.
-        """
-        data_dict = {}
-        for i in range(20):
-            var_name = 'x%i' % (i + 1)
-            var_value = (i + 1) * 10
-            var_obj = Data(var_name, var_value)
-            if (i+1)%2==0:
-                data_dict.update({var_name: var_obj})
-            elif 1+((i+1)%10)==self.site_id:
-                data_dict.update({var_name: var_obj})
-            else:
-                continue
-        return data_dict
+    def __getstate__(self):
+        """The site without its lock, for saved states of the transaction manager."""
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    @property
+    def data(self):
+        """Variable -> data mapping of the site."""
+        return self.store.site_data(self.site_id)
     
     def _initialise_graph(self):
         """Creates a empty graph for the site"""
         graph = SerializationGraph()
         return graph
     
-    def _create_sets(self, transaction):
-        write_set = set()
-        read_set = set()
-        transaction_record = transaction.transaction_record
-        for key in transaction_record.keys():
-            for operations in transaction_record[key]:
-                if operations[0] == "r":
-                    read_set.add(key)
-                elif operations[0] == "w":
-                    write_set.add(key)
-        return read_set, write_set
+    def _index_transaction(self, transaction : Transaction):
+        """Add a transaction kept in ssi_info to the per-variable conflict index."""
+        read_set, write_set = transaction.get_read_write_sets()
+        for variable in read_set:
+            self.readers[variable].add(transaction.id)
+        for variable in write_set:
+            self.writers[variable].add(transaction.id)
+
+    def _unindex_transaction(self, transaction : Transaction):
+        """Remove a transaction from the per-variable conflict index."""
+        read_set, write_set = transaction.get_read_write_sets()
+        for variable in read_set:
+            self.readers[variable].discard(transaction.id)
+            if not self.readers[variable]:
+                del self.readers[variable]
+        for variable in write_set:
+            self.writers[variable].discard(transaction.id)
+            if not self.writers[variable]:
+                del self.writers[variable]
+
+    def reindex_transaction(self, transaction_id, read_write_sets=None):
+        """
+        Index a transaction kept in ssi_info again after operations were recorded
+        for it after its commit, optionally replacing its read and write sets.
+        """
+        transaction = self.ssi_info.get(transaction_id)
+        if transaction is None:
+            return
+        self._unindex_transaction(transaction)
+        if read_write_sets is not None:
+            transaction.read_set, transaction.write_set = read_write_sets
+        self._index_transaction(transaction)
+
+    def _conflicting_transactions(self, read_set, write_set):
+        """
+        Returns the ids of transactions in ssi_info that share a variable with the
+        given read and write sets in a way that can produce an edge.
+        """
+        candidates = set()
+        for variable in write_set:
+            candidates.update(self.writers.get(variable, ()))
+            candidates.update(self.readers.get(variable, ()))
+        for variable in read_set:
+            candidates.update(self.writers.get(variable, ()))
+        return candidates
 
     def write(self, transaction : Transaction, tick):
         """Write data to the site for a given transaction."""
-        transaction_record = transaction.transaction_record
-        for key in transaction_record.keys():
-            for operations in transaction_record[key]:
-                if operations[0] == "w":
-                    if key in self.data:
-                        self.data[key].setValue(operations[1], tick)
-                    else:
-                        continue
-                else:
-                    continue
+        for key, write in transaction.writes():
+            if self.store.has(self.site_id, key):
+                self.store.write(self.site_id, key, write.value, tick)
         return
     
-    def write_data(self, variable, value, tick):
-        """Update a particular variable value for the site."""
-        self.data[variable].setValue(value, tick)
+    def write_data(self, variable, value, tick, horizon=None):
+        """
+        Update a particular variable value for the site. Versions no snapshot
+        at or after horizon can see are vacuumed.
+        """
+        self.store.write(self.site_id, variable, value, tick, horizon)
 
     def updateGraph(self, transaction : Transaction, tick : int):
-        """Update the graph at the site."""
+        """
+        Update the graph at the site. Returns False, after removing the transaction,
+        if committing it would create a dangerous structure.
+        """
 
-        read_set, write_set = self._create_sets(transaction)
+        read_set, write_set = transaction.get_read_write_sets()
         if not self.ssi_info:
             # print("Comitted %s" % transaction.id)
             transaction.commit_time = tick
             self.ssi_info.update({transaction.id : transaction})
-            self.graph.add_edge(transaction.id, '', '')
+            self._index_transaction(transaction)
+            self.graph.add_node(transaction.id)
             return True
 
-        for tx in self.ssi_info.keys():
-            # print(tx)
+        for tx in self._conflicting_transactions(read_set, write_set):
             tx_obj = self.ssi_info[tx]
-            tx_read_set, tx_write_set = self._create_sets(tx_obj)
+            tx_read_set, tx_write_set = tx_obj.get_read_write_sets()
             if tx_obj.commit_time < transaction.start_time:
                 if not tx_write_set.isdisjoint(write_set):
                     self.graph.add_edge(tx_obj.id, transaction.id, "ww") 
@@ -96,15 +142,41 @@ class Site:
             if transaction.start_time < tx_obj.commit_time:
                 if not read_set.isdisjoint(tx_write_set):
                     self.graph.add_edge(transaction.id, tx_obj.id,  "rw")
-        if self.graph.has_cycle_with_two_rw():
-            print("Abort %s" % transaction.id)
+        if self.graph.creates_dangerous_structure(transaction.id):
             self.remove_aborted_transaction(transaction)
             return False
         else:
             self.ssi_info.update({transaction.id : transaction})
+            self._index_transaction(transaction)
             # print("Comitted %s" % transaction.id)
             return True
     
+    def validate_batch(self, transactions, ticks):
+        """
+        Validate transactions that commit one after the other at the given ticks, each
+        as if the ones before it had committed. Stops at the first one that would
+        create a dangerous structure and returns its position, None if all pass.
+        """
+        for position, (transaction, tick) in enumerate(zip(transactions, ticks)):
+            if not self.updateGraph(transaction, tick):
+                return position
+            transaction.commit_time = tick
+        return None
+
+    def has_earlier_writer(self, transaction : Transaction):
+        """
+        Checks if a transaction in ssi_info that committed before the given one started
+        wrote a variable it read. Such a wr edge is the only edge a transaction without
+        writes can get into it, so without one it can never be part of a cycle.
+        """
+        read_set, _ = transaction.get_read_write_sets()
+        for tx in self._conflicting_transactions(read_set, ()):
+            tx_obj = self.ssi_info[tx]
+            _, tx_write_set = tx_obj.get_read_write_sets()
+            if tx_obj.commit_time < transaction.start_time and not tx_write_set.isdisjoint(read_set):
+                return True
+        return False
+
     def remove_aborted_transaction(self, transaction : Transaction):
         """
         Remove a transaction from the snapshot isolation information
@@ -113,16 +185,98 @@ class Site:
         self.graph.remove_transaction(transaction.id)
         if transaction.id in self.ssi_info.keys():
             self.ssi_info.pop(transaction.id)
+            self._unindex_transaction(transaction)
         
 
-    def failSite(self):
+    def remove_committed_transactions(self, transaction_ids):
+        """
+        Drop committed transactions that can no longer take part in a
+        dangerous structure from the snapshot isolation information and the graph.
+        """
+        for tx in transaction_ids:
+            if tx in self.ssi_info:
+                self._unindex_transaction(self.ssi_info.pop(tx))
+        self.graph.remove_transactions(transaction_ids)
+
+    def reachable_from(self, roots):
+        """Transactions reachable from the given ones in the serialization graph of the site."""
+        return self.graph.reachable_from(roots)
+
+    def gauges(self):
+        """Size of the snapshot isolation information and the serialization graph of the site."""
+        return {
+            "ssi_info": len(self.ssi_info),
+            "graph_nodes": len(self.graph),
+            "graph_edges": self.graph.edge_count(),
+        }
+
+    def failSite(self, tick : int):
         """Mark site as failed."""
         self.health = False
+        self.history.append((tick, self.health, self.last_down_time))
         self.ssi_info = {}
+        self.readers.clear()
+        self.writers.clear()
+        # transactions validated after a recovery never get edges to the ones before
+        # the failure, so the old graph cannot take part in a dangerous structure anymore
+        self.graph = self._initialise_graph()
         return self.health
 
-    def recoverSite(self, lastdowntime : int):
+    def recoverSite(self, lastdowntime : int, tick : int):
         """Recover site."""
         self.health = True
         self.last_down_time = lastdowntime
-        return self.health
\ No newline at end of file
+        self.history.append((tick, self.health, self.last_down_time))
+        return self.health
+
+    def state_at(self, tick : int):
+        """Returns the (health, last_down_time) a snapshot taken at tick would see."""
+        index = bisect_left(self.history, (tick,))
+        _, health, last_down_time = self.history[max(index - 1, 0)]
+        return health, last_down_time
+
+    def first_recovery_after(self, tick : int):
+        """Returns the tick of the first recovery after tick, or None if there was none yet."""
+        for event_tick, health, _ in self.history[bisect_left(self.history, (tick,)):]:
+            if health and event_tick > tick:
+                return event_tick
+        return None
+
+    def mark_caught_up(self, variable : str, tick : int):
+        """Record that catch-up made a replicated variable current at tick."""
+        self.caught_up[variable].append((tick, True))
+
+    def mark_stale(self, variable : str, tick : int):
+        """
+        Record that a commit at tick did not write a variable catch-up made current,
+        so the copy is no longer current. Returns True if there was such a copy.
+        """
+        ticks = self.caught_up.get(variable)
+        if not ticks or not ticks[-1][1]:
+            return False
+        ticks.append((tick, False))
+        return True
+
+    def caught_up_between(self, variable : str, low : int, high : int):
+        """
+        Checks if catch-up made the variable current after low and before high,
+        and no commit skipped the site since then.
+        """
+        ticks = self.caught_up.get(variable)
+        if not ticks:
+            return False
+        index = bisect_left(ticks, (high,))
+        if index == 0:
+            return False
+        tick, current = ticks[index - 1]
+        return current and tick > low
+
+    def vacuum(self, horizon : int):
+        """Drop failure and catch-up history that no snapshot taken at or after horizon can see."""
+        index = bisect_left(self.history, (horizon,))
+        if index > 1:
+            del self.history[:index - 1]
+        for ticks in self.caught_up.values():
+            index = bisect_left(ticks, (horizon,))
+            if index > 1:
+                del ticks[:index - 1]
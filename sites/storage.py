@@ -0,0 +1,261 @@
+'''
+Storage engines holding the data of every site.
+'''
+
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional
+from sites.data import Data
+from sites.topology import Topology
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for the columnar engine
+    np = None
+
+STORAGE_ENGINES = ['object', 'columnar']
+
+class ObjectStore:
+    """
+    The default storage engine. Every site keeps a dictionary with one `Data`
+    object per variable stored at it.
+    """
+
+    def __init__(self, topology: Topology, site_ids: Optional[Iterable[int]] = None):
+        self.topology = topology
+        self.data: Dict[int, Dict[str, Data]] = {}
+        for site_id in (site_ids if site_ids is not None else topology.site_ids):
+            self.data[site_id] = {
+                var_name: Data(var_name, topology.initial_value(var_name))
+                for var_name in topology.variables_at(site_id)
+            }
+
+    def site_data(self, site_id: int):
+        """Returns the variable -> data mapping of a site."""
+        return self.data[site_id]
+
+    def has(self, site_id: int, variable: str) -> bool:
+        """Checks if a variable is stored at a site."""
+        return variable in self.data[site_id]
+
+    def value(self, site_id: int, variable: str):
+        """Current value of a variable at a site."""
+        return self.data[site_id][variable].value
+
+    def last_write_time(self, site_id: int, variable: str) -> int:
+        """Commit time of the current value of a variable at a site."""
+        return self.data[site_id][variable].lastWriteTime
+
+    def value_at(self, site_id: int, variable: str, tick: int):
+        """Value of a variable at a site as seen by a snapshot taken at tick."""
+        return self.data[site_id][variable].value_at(tick)
+
+    def last_write_time_at(self, site_id: int, variable: str, tick: int) -> int:
+        """Last write time of a variable at a site as seen by a snapshot taken at tick."""
+        return self.data[site_id][variable].last_write_time_at(tick)
+
+    @staticmethod
+    def accepts(value) -> bool:
+        """Checks if a value can be stored, any value can."""
+        return True
+
+    def write(self, site_id: int, variable: str, value, tick: int, horizon: Optional[int] = None):
+        """Commit a value of a variable at a site, vacuuming versions older than horizon."""
+        data = self.data[site_id][variable]
+        data.setValue(value, tick)
+        if horizon is not None:
+            data.vacuum(horizon)
+
+    def vacuum(self, site_ids: Iterable[int], variables: Iterable[str], horizon: int):
+        """Drop versions of the variables at the given sites that no snapshot taken at or after horizon can see."""
+        for site_id in site_ids:
+            site_data = self.data[site_id]
+            for variable in variables:
+                data = site_data.get(variable)
+                if data is not None:
+                    data.vacuum(horizon)
+
+    def any_write_after(self, site_ids: Iterable[int], variables: Iterable[str], tick: int) -> bool:
+        """Checks if any of the variables was committed after tick at any of the given sites."""
+        for variable in variables:
+            for site_id in site_ids:
+                data = self.data[site_id].get(variable)
+                if data is not None and data.lastWriteTime > tick:
+                    return True
+        return False
+
+    def table(self, site_ids: Iterable[int], variables: List[str]) -> List[list]:
+        """Current values of the variables at the given sites, None where a variable is not stored."""
+        rows = []
+        for site_id in site_ids:
+            site_data = self.data[site_id]
+            rows.append([site_data[var].value if var in site_data else None for var in variables])
+        return rows
+
+
+class ColumnarSiteView:
+    """Read only mapping view of one site of a `ColumnarStore`, yielding `Data` copies."""
+
+    def __init__(self, store: "ColumnarStore", site_id: int):
+        self.store = store
+        self.site_id = site_id
+
+    def __contains__(self, variable):
+        return self.store.has(self.site_id, variable)
+
+    def __getitem__(self, variable):
+        if variable not in self:
+            raise KeyError(variable)
+        data = Data(variable, self.store.value(self.site_id, variable))
+        data.lastWriteTime = self.store.last_write_time(self.site_id, variable)
+        return data
+
+    def get(self, variable, default=None):
+        return self[variable] if variable in self else default
+
+    def keys(self):
+        return [variable for variable in self.store.topology.variables if variable in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return int(self.store.present[self.site_id - 1].sum())
+
+
+class ColumnarStore:
+    """
+    Storage engine keeping the current values, last write ticks and presence of every
+    variable at every site as dense sites x variables NumPy arrays, so that scans over
+    the whole database are vectorized. Values must be integers. Older versions still
+    visible to running snapshots are kept on the side, per (site, variable) cell.
+    """
+
+    def __init__(self, topology: Topology):
+        if np is None:
+            raise ImportError("The columnar storage engine requires numpy")
+        self.topology = topology
+        shape = (topology.num_sites, topology.num_variables)
+        self.present = np.zeros(shape, dtype=bool)
+        for j, variable in enumerate(topology.variables):
+            self.present[[site_id - 1 for site_id in topology.placement[variable]], j] = True
+        initial = np.array([topology.initial_value(var) for var in topology.variables], dtype=np.int64)
+        self.values = np.where(self.present, initial, 0)
+        self.ticks = np.zeros(shape, dtype=np.int64)
+        # (site row, variable column) -> older (tick, value) versions, oldest first
+        self.versions: Dict[tuple, list] = {}
+
+    def _cell(self, site_id: int, variable: str):
+        column = self.topology.index.get(variable)
+        if column is None or not self.present[site_id - 1, column]:
+            raise KeyError(variable)
+        return site_id - 1, column
+
+    def site_data(self, site_id: int):
+        """Returns a read only variable -> data mapping of a site."""
+        return ColumnarSiteView(self, site_id)
+
+    def has(self, site_id: int, variable: str) -> bool:
+        """Checks if a variable is stored at a site."""
+        column = self.topology.index.get(variable)
+        return column is not None and bool(self.present[site_id - 1, column])
+
+    def value(self, site_id: int, variable: str):
+        """Current value of a variable at a site."""
+        return self.values[self._cell(site_id, variable)].item()
+
+    def last_write_time(self, site_id: int, variable: str) -> int:
+        """Commit time of the current value of a variable at a site."""
+        return self.ticks[self._cell(site_id, variable)].item()
+
+    def _version_at(self, site_id: int, variable: str, tick: int):
+        cell = self._cell(site_id, variable)
+        current_tick = self.ticks[cell].item()
+        if current_tick < tick:
+            return current_tick, self.values[cell].item()
+        versions = self.versions.get(cell, [])
+        index = bisect_left(versions, (tick,))
+        return versions[max(index - 1, 0)]
+
+    def value_at(self, site_id: int, variable: str, tick: int):
+        """Value of a variable at a site as seen by a snapshot taken at tick."""
+        return self._version_at(site_id, variable, tick)[1]
+
+    def last_write_time_at(self, site_id: int, variable: str, tick: int) -> int:
+        """Last write time of a variable at a site as seen by a snapshot taken at tick."""
+        return self._version_at(site_id, variable, tick)[0]
+
+    @staticmethod
+    def accepts(value) -> bool:
+        """Checks if a value can be stored, only integers that fit in int64 can."""
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return False
+        return -2**63 <= value < 2**63
+
+    def write(self, site_id: int, variable: str, value, tick: int, horizon: Optional[int] = None):
+        """Commit a value of a variable at a site, vacuuming versions older than horizon."""
+        cell = self._cell(site_id, variable)
+        current_tick = self.ticks[cell].item()
+        if horizon is not None and horizon >= tick:
+            # no active snapshot started at or before tick, none can see the older versions
+            self.versions.pop(cell, None)
+        elif current_tick != tick:
+            self.versions.setdefault(cell, []).append((current_tick, self.values[cell].item()))
+        self.values[cell] = int(value)
+        self.ticks[cell] = tick
+        if horizon is not None:
+            self._vacuum_cell(cell, horizon)
+
+    def _vacuum_cell(self, cell: tuple, horizon: int):
+        versions = self.versions.get(cell)
+        if versions is None:
+            return
+        if self.ticks[cell].item() <= horizon:
+            del self.versions[cell]
+        else:
+            index = bisect_left(versions, (horizon,))
+            if index > 1:
+                del versions[:index - 1]
+
+    def vacuum(self, site_ids: Iterable[int], variables: Iterable[str], horizon: int):
+        """Drop versions of the variables at the given sites that no snapshot taken at or after horizon can see."""
+        columns = [self.topology.index[var] for var in variables if var in self.topology.index]
+        for site_id in site_ids:
+            for column in columns:
+                self._vacuum_cell((site_id - 1, column), horizon)
+
+    def any_write_after(self, site_ids: Iterable[int], variables: Iterable[str], tick: int) -> bool:
+        """Checks if any of the variables was committed after tick at any of the given sites."""
+        rows = [site_id - 1 for site_id in site_ids]
+        columns = [self.topology.index[var] for var in variables if var in self.topology.index]
+        if not rows or not columns:
+            return False
+        cells = np.ix_(rows, columns)
+        return bool(((self.ticks[cells] > tick) & self.present[cells]).any())
+
+    def table(self, site_ids: Iterable[int], variables: List[str]) -> List[list]:
+        """Current values of the variables at the given sites, None where a variable is not stored."""
+        rows = [site_id - 1 for site_id in site_ids]
+        columns = [self.topology.index[var] for var in variables]
+        cells = np.ix_(rows, columns)
+        values = np.where(self.present[cells], self.values[cells], None)
+        return values.tolist()
+
+
+def store_class(engine: str):
+    """The class of the storage engine with the given name."""
+    if engine == 'object':
+        return ObjectStore
+    if engine == 'columnar':
+        return ColumnarStore
+    raise ValueError("Unknown storage engine %s, expected one of %s" % (engine, ", ".join(STORAGE_ENGINES)))
+
+
+def create_store(engine: str, topology: Topology):
+    """Creates the storage engine with the given name for a topology."""
+    if engine == 'object':
+        return ObjectStore(topology)
+    if engine == 'columnar':
+        return ColumnarStore(topology)
+    raise ValueError("Unknown storage engine %s, expected one of %s" % (engine, ", ".join(STORAGE_ENGINES)))
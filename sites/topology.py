@@ -0,0 +1,49 @@
+'''
+Size of the database and placement of every variable on the sites.
+'''
+
+from typing import Dict, List, Tuple
+
+class Topology:
+    """
+    Describes how many sites and variables the database has and where each variable
+    lives. Variables are named x1..xN. Even numbered variables are replicated at all
+    sites whereas odd numbered variable xi is only present at site 1 + (i mod number
+    of sites). The placement map is built once so that routing never has to parse
+    variable names.
+    """
+
+    def __init__(self, num_sites: int = 10, num_variables: int = 20):
+        if num_sites < 1 or num_variables < 0:
+            raise ValueError("A database needs at least one site and a non negative number of variables")
+        self.num_sites = num_sites
+        self.num_variables = num_variables
+        self.site_ids = list(range(1, num_sites + 1))
+        self.variables: List[str] = ['x%i' % i for i in range(1, num_variables + 1)]
+        self.index: Dict[str, int] = {variable: i for i, variable in enumerate(self.variables)}
+        self.replicated = set()
+        self.placement: Dict[str, Tuple[int, ...]] = {}
+        all_sites = tuple(self.site_ids)
+        for i, variable in enumerate(self.variables, start=1):
+            if i % 2 == 0:
+                self.replicated.add(variable)
+                self.placement[variable] = all_sites
+            else:
+                self.placement[variable] = (1 + i % num_sites,)
+
+    def sites_of(self, variable: str) -> Tuple[int, ...]:
+        """Returns the ids of the sites a variable is stored at, empty for unknown variables."""
+        return self.placement.get(variable, ())
+
+    def is_replicated(self, variable: str) -> bool:
+        """Checks if a variable is replicated at all sites."""
+        return variable in self.replicated
+
+    def initial_value(self, variable: str) -> int:
+        """Initial value of a variable, xi starts at 10 * i."""
+        return int(variable[1:]) * 10
+
+    def variables_at(self, site_id: int) -> List[str]:
+        """Returns the variables stored at a site, in variable order."""
+        return [variable for variable in self.variables
+                if variable in self.replicated or self.placement[variable][0] == site_id]
@@ -0,0 +1,139 @@
+'''
+Write-ahead log and checkpoints that make the committed data of a site durable.
+'''
+
+import json
+import os
+from typing import Dict, List, Tuple
+
+
+class WriteAheadLog:
+    """
+    Append only log of the writes committed at one site, one JSON line
+    [tick, [[variable, value], ...]] per committing transaction, and of its failures
+    and recoveries, one line [tick, "down" or "up", last down time] each, next to a
+    checkpoint of the values of the site.
+
+    Group commit: appended records are buffered and written and fsynced together once
+    group_size of them are pending, or on sync. The transaction manager holds back the
+    reports of commits until group_size of them share one sync of every log they wrote
+    to, so no commit is reported before it is durable. Failures and recoveries are
+    synced right away.
+
+    A checkpoint {"tick": t, "cells": {variable: [value, last write time]},
+    "status": [health, last down time, tick]} is written to a temporary file and
+    atomically moved in place, after which the log is truncated. Recovery loads the
+    checkpoint and replays only the records after it.
+    """
+
+    def __init__(self, directory: str, site_id: int, group_size: int = 32):
+        self.directory = directory
+        self.site_id = site_id
+        self.group_size = group_size
+        self.log_path = os.path.join(directory, "site%i.wal" % site_id)
+        self.checkpoint_path = os.path.join(directory, "site%i.checkpoint" % site_id)
+        self.pending: List[str] = []
+        self.records_since_checkpoint = 0
+        # health, last down time and tick of the last failure or recovery of the site
+        self.status = [True, -1, 0]
+        os.makedirs(directory, exist_ok=True)
+        self.log_file = None
+
+    def recover(self) -> Tuple[int, Dict[str, list], List[tuple]]:
+        """
+        Returns the tick of the checkpoint, its cells and the (tick, writes) records
+        logged after it. The status of the site is restored as of the last failure or
+        recovery logged. A torn last record is cut off the log.
+        """
+        checkpoint_tick, cells = 0, {}
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            checkpoint_tick, cells = checkpoint["tick"], checkpoint["cells"]
+            self.status = checkpoint.get("status", self.status)
+        records = []
+        if os.path.exists(self.log_path):
+            valid_length = 0
+            with open(self.log_path, 'rb') as log_file:
+                for line in log_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    valid_length += len(line)
+                    tick = record[0]
+                    if tick <= checkpoint_tick:
+                        continue
+                    if isinstance(record[1], str):
+                        self.status = [record[1] == "up", record[2], tick]
+                    else:
+                        records.append((tick, record[1]))
+            if valid_length != os.path.getsize(self.log_path):
+                with open(self.log_path, 'r+b') as log_file:
+                    log_file.truncate(valid_length)
+        self.records_since_checkpoint = len(records)
+        return checkpoint_tick, cells, records
+
+    def append(self, tick: int, writes: List[tuple]):
+        """Log the writes a transaction committed at the site at tick."""
+        self.pending.append(json.dumps([tick, writes]) + "\n")
+        self.records_since_checkpoint += 1
+        if len(self.pending) >= self.group_size:
+            self.sync()
+
+    def append_status(self, tick: int, health: bool, last_down_time: int):
+        """Log a failure or recovery of the site at tick and sync it."""
+        self.status = [health, last_down_time, tick]
+        self.pending.append(json.dumps([tick, "up" if health else "down", last_down_time]) + "\n")
+        self.records_since_checkpoint += 1
+        self.sync()
+
+    def sync(self):
+        """Write and fsync the pending records."""
+        if not self.pending:
+            return
+        if self.log_file is None:
+            self.log_file = open(self.log_path, 'a')
+        self.log_file.write("".join(self.pending))
+        self.pending = []
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+
+    def checkpoint(self, tick: int, cells: Dict[str, list]):
+        """Replace the checkpoint with the given cells as of tick and truncate the log."""
+        self.sync()
+        temporary_path = self.checkpoint_path + ".tmp"
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump({"tick": tick, "cells": cells, "status": self.status}, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temporary_path, self.checkpoint_path)
+        _fsync_directory(self.directory)
+        # every logged record is in the checkpoint now
+        if self.log_file is not None:
+            self.log_file.close()
+        self.log_file = open(self.log_path, 'w')
+        self.records_since_checkpoint = 0
+
+    def close(self):
+        """Sync the pending records and close the log."""
+        self.sync()
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+
+def _fsync_directory(directory: str):
+    """Make a rename in directory durable, where the platform allows it."""
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
@@ -0,0 +1,282 @@
+'''
+Typed results of processing operations.
+
+Every outcome the transaction manager reports is an event. Events are cheap
+records, turning them into text or JSON is left to the sinks they are pushed
+to, see transaction_handling.sinks.
+'''
+
+import json
+from tabulate import tabulate
+from transaction_handling.metrics import NO_AVAILABLE_SITES, CLIENT_ABORT
+
+class Event:
+    """Base class of all events. `render` gives the text the database has always printed."""
+
+    __slots__ = ()
+    kind = 'event'
+
+    def render(self) -> str:
+        raise NotImplementedError
+
+    def to_dict(self) -> dict:
+        result = {"event": self.kind}
+        for cls in reversed(type(self).__mro__):
+            for field in getattr(cls, '__slots__', ()):
+                result[field] = getattr(self, field)
+        return result
+
+    def __repr__(self):
+        fields = self.to_dict()
+        fields.pop("event")
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % item for item in fields.items()))
+
+
+class TransactionEvent(Event):
+    """An event about a single transaction."""
+
+    __slots__ = ('transaction_id',)
+
+    def __init__(self, transaction_id: str):
+        self.transaction_id = transaction_id
+
+
+class ReadResult(TransactionEvent):
+    kind = 'read'
+    __slots__ = ('variable', 'value')
+
+    def __init__(self, transaction_id: str, variable: str, value):
+        super().__init__(transaction_id)
+        self.variable = variable
+        self.value = value
+
+    def render(self):
+        return "Read successful\n%s: %s" % (self.variable, self.value)
+
+
+class WriteAccepted(TransactionEvent):
+    kind = 'write'
+    __slots__ = ('variable', 'sites')
+
+    def __init__(self, transaction_id: str, variable: str, sites):
+        super().__init__(transaction_id)
+        self.variable = variable
+        self.sites = sites
+
+    def render(self):
+        return "We can write to  %s" % list(self.sites)
+
+    def to_dict(self):
+        result = super().to_dict()
+        result["sites"] = list(self.sites)
+        return result
+
+
+class Waiting(TransactionEvent):
+    kind = 'waiting'
+    __slots__ = ()
+
+    def render(self):
+        return "Waiting Transaction because of no available sites %s" % self.transaction_id
+
+
+class AlreadyAborted(TransactionEvent):
+    kind = 'already_aborted'
+    __slots__ = ()
+
+    def render(self):
+        return "Transaction has already aborted %s" % self.transaction_id
+
+
+class SiteDownAfterWrite(TransactionEvent):
+    kind = 'site_down_after_write'
+    __slots__ = ('site_id',)
+
+    def __init__(self, transaction_id: str, site_id: int):
+        super().__init__(transaction_id)
+        self.site_id = site_id
+
+    def render(self):
+        return "Site %s was down after %s wrote to it" % (self.site_id, self.transaction_id)
+
+
+class DangerousStructure(TransactionEvent):
+    kind = 'dangerous_structure'
+    __slots__ = ('site_id',)
+
+    def __init__(self, transaction_id: str, site_id: int):
+        super().__init__(transaction_id)
+        self.site_id = site_id
+
+    def render(self):
+        return "Abort %s" % self.transaction_id
+
+
+class Committed(TransactionEvent):
+    kind = 'committed'
+    __slots__ = ('commit_time',)
+
+    def __init__(self, transaction_id: str, commit_time: int):
+        super().__init__(transaction_id)
+        self.commit_time = commit_time
+
+    def render(self):
+        return "Transaction committed %s" % self.transaction_id
+
+
+class Aborted(TransactionEvent):
+    kind = 'aborted'
+    __slots__ = ('reason',)
+
+    def __init__(self, transaction_id: str, reason: str):
+        super().__init__(transaction_id)
+        self.reason = reason
+
+    def render(self):
+        if self.reason == NO_AVAILABLE_SITES:
+            return "Aborted Transaction because of no available sites %s" % self.transaction_id
+        if self.reason == CLIENT_ABORT:
+            return "Aborted Transaction because its client left %s" % self.transaction_id
+        return "Aborted Transaction because it cannot commit %s" % self.transaction_id
+
+
+class SiteFailed(Event):
+    kind = 'site_failed'
+    __slots__ = ('site_id',)
+
+    def __init__(self, site_id: int):
+        self.site_id = site_id
+
+    def render(self):
+        return "Site %s failed" % self.site_id
+
+
+class SiteRecovered(Event):
+    kind = 'site_recovered'
+    __slots__ = ('site_id',)
+
+    def __init__(self, site_id: int):
+        self.site_id = site_id
+
+    def render(self):
+        return "Site %s recovered" % self.site_id
+
+
+class Dump(Event):
+    """Values of the variables at every site, None where a variable is not stored."""
+
+    kind = 'dump'
+    __slots__ = ('site_ids', 'variables', 'rows')
+
+    def __init__(self, site_ids, variables, rows):
+        self.site_ids = site_ids
+        self.variables = variables
+        self.rows = rows
+
+    def render(self):
+        table = []
+        for site_id, site_values in zip(self.site_ids, self.rows):
+            row = ["S%s" % site_id]  # Start with site name
+            # '*' if the variable is not stored at the site
+            row.extend('*' if value is None else value for value in site_values)
+            table.append(row)
+        header = [""] + list(self.variables)
+        return tabulate(table, headers=header, tablefmt="grid")
+
+    def to_dict(self):
+        return {"event": self.kind,
+                "sites": {site_id: {var: value for var, value in zip(self.variables, site_values) if value is not None}
+                          for site_id, site_values in zip(self.site_ids, self.rows)}}
+
+
+DUMP_FORMATS = ('grid', 'csv', 'jsonl')
+
+
+class DumpHeader(Event):
+    """Header line of a dump in csv format."""
+
+    kind = 'dump_header'
+    __slots__ = ()
+
+    def render(self):
+        return "site,variable,value"
+
+
+class DumpRow(Event):
+    """The (variable, value) pairs of one site in a streamed dump."""
+
+    kind = 'dump_row'
+    __slots__ = ('site_id', 'cells', 'format')
+
+    def __init__(self, site_id: int, cells, format: str):
+        self.site_id = site_id
+        self.cells = cells
+        self.format = format
+
+    def render(self):
+        if self.format == 'csv':
+            return "\n".join("%s,%s,%s" % (self.site_id, variable, value) for variable, value in self.cells)
+        return json.dumps({"site": self.site_id, "values": dict(self.cells)})
+
+    def to_dict(self):
+        return {"event": self.kind, "site": self.site_id, "values": dict(self.cells)}
+
+
+class QueryState(Event):
+    kind = 'querystate'
+    __slots__ = ('state', 'as_json')
+
+    def __init__(self, state: dict, as_json: bool = False):
+        self.state = state
+        self.as_json = as_json
+
+    def render(self):
+        state = self.state
+        if self.as_json:
+            return json.dumps(state)
+        rows = [[op_type, count] + [state["latency"][op_type][key] for key in ("mean_us", "p50_us", "p99_us", "max_us")]
+                for op_type, count in sorted(state["operations"].items())]
+        lines = [tabulate(rows, headers=["operation", "count", "mean us", "p50 us", "p99 us", "max us"])]
+        lines.append("Commits: %i, read-only fast path: %i" % (state["commits"], state["read_only_commits"]))
+        lines.append("Aborts: " + ", ".join("%s %i" % (reason, count) for reason, count in state["aborts"].items()))
+        gauges = state["gauges"]
+        lines.append("Active transactions: %i, retained committed transactions: %i, pending operations: %i, "
+                     "reclaimed transactions: %i, snapshot bytes: %i"
+                     % (gauges["active_transactions"], gauges["retained_transactions"], gauges["pending_operations"],
+                        gauges["reclaimed_transactions"], gauges["snapshot_bytes"]))
+        for site_id, site_gauges in gauges["sites"].items():
+            lines.append("Site %s: ssi_info %i, graph %i nodes %i edges" % (site_id, site_gauges["ssi_info"],
+                                                                           site_gauges["graph_nodes"],
+                                                                           site_gauges["graph_edges"]))
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {"event": self.kind, **self.state}
+
+
+class OperationError(Event):
+    """An operation failed with an unexpected error, the database kept running."""
+    kind = 'error'
+    __slots__ = ('message',)
+
+    def __init__(self, message: str):
+        self.message = message
+
+    def render(self):
+        return "Error: %s" % self.message
+
+
+class InvalidOperation(Event):
+    kind = 'invalid'
+    __slots__ = ()
+
+    def render(self):
+        return "Not a valid operation!"
+
+
+class Bye(Event):
+    kind = 'exit'
+    __slots__ = ()
+
+    def render(self):
+        return "Bye!"
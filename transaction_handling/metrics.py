@@ -0,0 +1,99 @@
+'''
+Counters and latency histograms of the transaction manager.
+'''
+
+from collections import Counter
+from typing import Dict
+
+FIRST_COMMITTER_WINS = 'first-committer-wins'
+SSI_CYCLE = 'ssi-cycle'
+AVAILABLE_COPIES = 'available-copies'
+NO_AVAILABLE_SITES = 'no-available-sites'
+# aborted on behalf of its client, e.g. one that disconnected from the server
+CLIENT_ABORT = 'client-abort'
+ABORT_REASONS = [FIRST_COMMITTER_WINS, SSI_CYCLE, AVAILABLE_COPIES, NO_AVAILABLE_SITES, CLIENT_ABORT]
+
+class LatencyHistogram:
+    """
+    Histogram of latencies in nanoseconds with power of two buckets. Bucket i
+    counts the latencies in [2^i, 2^(i+1)), so recording is O(1) and the memory
+    is fixed no matter how many operations are seen.
+    """
+
+    BUCKETS = 48
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, latency_ns: int):
+        """Add one latency."""
+        self.buckets[min(max(latency_ns, 1).bit_length() - 1, self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total_ns += latency_ns
+        if latency_ns > self.max_ns:
+            self.max_ns = latency_ns
+
+    def percentile(self, fraction: float) -> int:
+        """Upper bound of the bucket holding the given percentile, in nanoseconds."""
+        if self.count == 0:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for i, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank and bucket:
+                return min(2 ** (i + 1), self.max_ns)
+        return self.max_ns
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_us": self.total_ns / self.count / 1000 if self.count else 0.0,
+            "p50_us": self.percentile(0.50) / 1000,
+            "p99_us": self.percentile(0.99) / 1000,
+            "max_us": self.max_ns / 1000,
+        }
+
+
+class Metrics:
+    """Operation counts, operation latencies, commits and aborts broken down by reason."""
+
+    def __init__(self):
+        self.operations = Counter()
+        self.latencies: Dict[str, LatencyHistogram] = {}
+        self.commits = 0
+        # commits of transactions without writes that never entered the serialization graphs
+        self.read_only_commits = 0
+        self.aborts = Counter({reason: 0 for reason in ABORT_REASONS})
+
+    def record_operation(self, op_type: str, latency_ns: int):
+        """Count an operation and the time it took."""
+        self.operations[op_type] += 1
+        histogram = self.latencies.get(op_type)
+        if histogram is None:
+            histogram = self.latencies[op_type] = LatencyHistogram()
+        histogram.record(latency_ns)
+
+    def record_commit(self, read_only: bool = False):
+        self.commits += 1
+        if read_only:
+            self.read_only_commits += 1
+
+    def record_abort(self, reason: str):
+        self.aborts[reason] += 1
+
+    @property
+    def aborted(self) -> int:
+        return sum(self.aborts.values())
+
+    def to_dict(self) -> dict:
+        return {
+            "operations": dict(self.operations),
+            "latency": {op_type: histogram.to_dict() for op_type, histogram in self.latencies.items()},
+            "commits": self.commits,
+            "read_only_commits": self.read_only_commits,
+            "aborts": dict(self.aborts),
+        }
@@ -2,74 +2,182 @@
 author: Sarthak Khandelwal
 '''
 
-from collections import defaultdict, deque
+from typing import Dict, List, Optional, Set
+
+# edge types as bit flags, the edges between two transactions share one int
+WW = 1
+WR = 2
+RW = 4
+EDGE_TYPES = {'ww': WW, 'wr': WR, 'rw': RW}
+
 
 class SerializationGraph:
+    """
+    Serialization graph of the transactions kept at a site. Transaction ids are
+    interned to small integers, slots of removed transactions are reused, and
+    every node keeps its successors with the edge type flags and its predecessors,
+    so adding an edge and removing a transaction only touch its own edges.
+    The string id API is unchanged.
+    """
 
     def __init__(self):
-        self.graph = defaultdict(dict)
-    
+        self.ids: Dict[str, int] = {}
+        self.names: List[Optional[str]] = []
+        # per node: successor -> edge type flags, and the set of predecessors
+        self.successors: List[Optional[Dict[int, int]]] = []
+        self.predecessors: List[Optional[Set[int]]] = []
+        # incremental rw-conflict state, kept up to date by add_edge/remove_transaction
+        self.rw_in: List[int] = []
+        self.rw_out: List[int] = []
+        self.pivots: Set[int] = set()
+        self.free: List[int] = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, tx):
+        return tx in self.ids
+
+    def edge_count(self):
+        """Number of ordered pairs of transactions with at least one edge."""
+        return sum(len(self.successors[node]) for node in self.ids.values())
+
+    def _intern(self, tx) -> int:
+        node = self.ids.get(tx)
+        if node is not None:
+            return node
+        if self.free:
+            node = self.free.pop()
+            self.names[node] = tx
+            self.successors[node] = {}
+            self.predecessors[node] = set()
+            self.rw_in[node] = self.rw_out[node] = 0
+        else:
+            node = len(self.names)
+            self.names.append(tx)
+            self.successors.append({})
+            self.predecessors.append(set())
+            self.rw_in.append(0)
+            self.rw_out.append(0)
+        self.ids[tx] = node
+        return node
+
+    def add_node(self, tx):
+        """Adds a transaction without any edges."""
+        self._intern(tx)
+
     def add_edge(self, from_tx, to_tx, edge_type):
         """
         Adds a edge between two transactions such that
                      edge_type
-            from_tx -----------> to_tx           
+            from_tx -----------> to_tx
+        An empty to_tx only adds from_tx.
         """
-        if from_tx not in self.graph.keys():
-            self.graph.update({from_tx: {}})
-        if to_tx != '':
-            if to_tx not in self.graph.keys():
-                self.graph.update({to_tx: {}})
-            try:
-                self.graph[from_tx][to_tx].add(edge_type)
-            except KeyError as e:
-                self.graph[from_tx][to_tx] = set()
-                self.graph[from_tx][to_tx].add(edge_type)
+        source = self._intern(from_tx)
+        if to_tx == '':
+            return
+        target = self._intern(to_tx)
+        flag = EDGE_TYPES[edge_type]
+        successors = self.successors[source]
+        flags = successors.get(target)
+        if flags is None:
+            flags = 0
+            self.predecessors[target].add(source)
+        if flag == RW and not flags & RW:
+            self.rw_out[source] += 1
+            self.rw_in[target] += 1
+            self._update_pivot(source)
+            self._update_pivot(target)
+        successors[target] = flags | flag
+
+    def _update_pivot(self, node):
+        """Track whether a transaction has both an inbound and an outbound rw edge."""
+        if self.rw_in[node] > 0 and self.rw_out[node] > 0:
+            self.pivots.add(node)
+        else:
+            self.pivots.discard(node)
 
     def remove_transaction(self, tx):
         """
         Remove a transaction from the graph. Removes the node
         and all edges associated with it.
         """
-        self.graph.pop(tx, None)
-        for neighbours in self.graph.values():
-            neighbours.pop(tx, None)
-    
-    def has_cycle_with_two_rw(self):
-        """
-        Detect if there is a cycle in the graph containing exactly two 
-        consecutive `rw` edges in a row.
-        """
-        def dfs(tx, visited, stack, prev_edge_type, rw_edge_count):
-            visited.add(tx)
-            stack.add(tx)
-
-            for neighbor, edge_type in self.graph[tx].items():
-                if 'rw' in edge_type:
-                    # Increment the count of consecutive `rw` edges if the previous edge was also `rw`
-                    rw_edge_count = rw_edge_count + 1 if prev_edge_type == 'rw' else 1
-                    edge_type = 'rw'
-
-                # If there are two consecutive `rw` edges, a problematic cycle is detected
-                if rw_edge_count >= 2 and neighbor in stack:
-                    return True
+        node = self.ids.pop(tx, None)
+        if node is None:
+            return
+        for successor, flags in self.successors[node].items():
+            if successor == node:
+                continue
+            self.predecessors[successor].discard(node)
+            if flags & RW:
+                self.rw_in[successor] -= 1
+                self._update_pivot(successor)
+        for predecessor in self.predecessors[node]:
+            if predecessor == node:
+                continue
+            if self.successors[predecessor].pop(node) & RW:
+                self.rw_out[predecessor] -= 1
+                self._update_pivot(predecessor)
+        self.names[node] = None
+        self.successors[node] = None
+        self.predecessors[node] = None
+        self.pivots.discard(node)
+        self.free.append(node)
 
-                # Continue DFS if the neighbor hasn't been visited
-                if neighbor not in visited:
-                    if dfs(neighbor, visited, stack, edge_type, rw_edge_count):
-                        return True
+    def remove_transactions(self, txs):
+        """Remove several transactions from the graph."""
+        for tx in txs:
+            self.remove_transaction(tx)
 
-            # Backtrack: remove current transaction from the stack
-            stack.remove(tx)
-            return False
+    def reachable_from(self, roots):
+        """Returns every transaction reachable from the given transactions, roots included."""
+        reachable = {self.ids[tx] for tx in roots if tx in self.ids}
+        stack = list(reachable)
+        while stack:
+            for successor in self.successors[stack.pop()]:
+                if successor not in reachable:
+                    reachable.add(successor)
+                    stack.append(successor)
+        return {self.names[node] for node in reachable}
 
-        visited = set()
-
-        # Start DFS from every unvisited node
-        for tx in self.graph:
-            if tx not in visited:
-                if dfs(tx, visited, set(), None, 0):  # Initialize with no previous edge and count 0
+    def creates_dangerous_structure(self, tx):
+        """
+        Checks if a transaction whose edges were just added closes a cycle with
+        two consecutive rw edges. A graph that passed the check before can only
+        gain a dangerous cycle through `tx`, so only the paths that leave `tx` by
+        one of its edges are followed until they come back to `tx`, tracking
+        whether the path arrived over an rw edge and already passed two in a row.
+        The search stops at the first dangerous cycle. It is skipped when `tx` has
+        no inbound or no outbound edges or no transaction is a pivot (rw edge in
+        and out).
+        """
+        node = self.ids.get(tx)
+        if node is None or not self.successors[node] or not self.predecessors[node]:
+            return False
+        if not self.pivots:
+            return False
+        # a path is (first edge was rw, last edge was rw, two rw edges in a row seen) and the
+        # edge it continues with, paths reaching a node in the same state are followed once
+        seen = set()
+        stack = []
+        entered_by_rw = left_by_rw = False
+        for successor, flags in self.successors[node].items():
+            rw = bool(flags & RW)
+            stack.append((rw, False, False, successor, rw))
+        while stack:
+            first_rw, last_rw, pair, successor, rw = stack.pop()
+            pair = pair or (rw and last_rw)
+            if successor == node:
+                # the two rw edges may also meet at tx, on the same or on different cycles
+                entered_by_rw = entered_by_rw or rw
+                left_by_rw = left_by_rw or first_rw
+                if pair or (entered_by_rw and left_by_rw):
                     return True
-
+                continue
+            state = (successor, first_rw, rw, pair)
+            if state in seen:
+                continue
+            seen.add(state)
+            for following, flags in self.successors[successor].items():
+                stack.append((first_rw, rw, pair, following, bool(flags & RW)))
         return False
-            
\ No newline at end of file
@@ -0,0 +1,81 @@
+'''
+Destinations for the events produced by the transaction manager.
+'''
+
+import json
+import sys
+from typing import List
+from transaction_handling.events import Event
+
+class Sink:
+    """Receives every event the transaction manager produces."""
+
+    def emit(self, event: Event):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class StdoutSink(Sink):
+    """
+    Writes events in the text format the database has always printed. Rendered
+    lines are batched and written together once batch_size events have been
+    collected, or on flush. A batch_size of 1 writes every event right away,
+    which is what an interactive session wants.
+    """
+
+    def __init__(self, batch_size: int = 256, stream=None):
+        self.batch_size = batch_size
+        self.stream = stream
+        self.buffer: List[Event] = []
+
+    def emit(self, event: Event):
+        self.buffer.append(event)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            stream = self.stream if self.stream is not None else sys.stdout
+            stream.write("".join(event.render() + "\n" for event in self.buffer))
+            self.buffer = []
+            stream.flush()
+
+
+class JsonLinesSink(StdoutSink):
+    """Writes one JSON object per event, batched like `StdoutSink`."""
+
+    def flush(self):
+        if self.buffer:
+            stream = self.stream if self.stream is not None else sys.stdout
+            stream.write("".join(json.dumps(event.to_dict()) + "\n" for event in self.buffer))
+            self.buffer = []
+            stream.flush()
+
+
+class NullSink(Sink):
+    """Discards every event, for benchmarks."""
+
+    def emit(self, event: Event):
+        pass
+
+
+class MemorySink(Sink):
+    """Keeps every event in a list, for embedding the database as a library."""
+
+    def __init__(self):
+        self.events: List[Event] = []
+
+    def emit(self, event: Event):
+        self.events.append(event)
+
+
+SINKS = {
+    'text': StdoutSink,
+    'jsonl': JsonLinesSink,
+    'none': NullSink,
+}
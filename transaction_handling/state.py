@@ -0,0 +1,65 @@
+'''
+Saved states of the transaction manager.
+
+A state file holds everything needed to continue a replay: the sites with their
+data, serialization graphs and ssi_info, the active transactions and their
+snapshots, the waiting operations, the metrics and the ticker. Replaying the
+same input from a state skips the first `ticker` operations.
+
+    header:  magic, format version
+    body:    zlib compressed pickle of the transaction manager
+'''
+
+import os
+import pickle
+import struct
+import zlib
+
+MAGIC = b'RPCS'
+VERSION = 1
+HEADER = struct.Struct('<4sH')
+
+
+class StateFormatError(Exception):
+    """Raised when a file is not a saved state this version can read."""
+
+
+def save_state(transaction_manager, path: str, level: int = 6) -> int:
+    """
+    Save the state of a transaction manager to path, replacing the file atomically,
+    and return the number of bytes written. Sites running in worker processes and
+    write-ahead logs are not part of a state.
+    """
+    body = zlib.compress(pickle.dumps(transaction_manager, protocol=pickle.HIGHEST_PROTOCOL), level)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'wb') as state_file:
+        state_file.write(HEADER.pack(MAGIC, VERSION))
+        state_file.write(body)
+    os.replace(temporary_path, path)
+    return HEADER.size + len(body)
+
+
+def load_state(path: str, sink=None):
+    """
+    Load a transaction manager saved with save_state. Its events go to the given
+    sink, by default they are printed.
+    """
+    with open(path, 'rb') as state_file:
+        header = state_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise StateFormatError("%s is not a saved state" % path)
+        magic, version = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise StateFormatError("%s is not a saved state" % path)
+        if version != VERSION:
+            raise StateFormatError("%s has state format version %i, expected %i" % (path, version, VERSION))
+        try:
+            transaction_manager = pickle.loads(zlib.decompress(state_file.read()))
+        except (zlib.error, pickle.UnpicklingError, EOFError) as error:
+            raise StateFormatError("%s is corrupt: %s" % (path, error))
+    if sink is not None:
+        transaction_manager.sink = sink
+    return transaction_manager
@@ -2,20 +2,84 @@
 author: Anand Trehan
 '''
 
-from typing import Dict
+from typing import Dict, Iterator, List, Tuple, Union
+
+
+class ReadEntry:
+    """A read in the transaction record. Reads carry no data, so one instance is shared."""
+    __slots__ = ()
+    kind = 'r'
+
+
+class WriteEntry:
+    """A write in the transaction record: the value, the sites it went to and its tick."""
+    __slots__ = ('value', 'sites', 'tick')
+    kind = 'w'
+
+    def __init__(self, value, sites, tick: int):
+        self.value = value
+        self.sites = sites
+        self.tick = tick
+
+    def __repr__(self):
+        return "WriteEntry(%r, %r, %r)" % (self.value, self.sites, self.tick)
+
+
+READ = ReadEntry()
+
 
 class Transaction:
-    
+    """
+    A transaction and its record of operations per variable. The read set, the write
+    set, the last value written to every variable and the tick of the first write are
+    kept up to date as operations are recorded, so none of them needs a pass over
+    the record.
+    """
+    __slots__ = ('id', 'start_time', 'transaction_record', 'commit_time', 'snapshot', 'snapshot_sites',
+                 'read_set', 'write_set', 'last_written', 'first_write', 'abort_reason', 'read_only')
+
     def __init__(self, id: str, start_time: int):
         self.id = id  # String to hold the transaction ID
         self.start_time = start_time  # Integer to hold the start time of the transaction
-        self.transaction_record : Dict[str,list] = {} #dictionary with all transactions
+        self.transaction_record : Dict[str,List[Union[ReadEntry, WriteEntry]]] = {} #dictionary with all operations
         self.commit_time = None
         self.snapshot = {}
         self.snapshot_sites = {}
+        self.read_set = set()
+        self.write_set = set()
+        self.last_written = {}
+        self.first_write = None
+        self.abort_reason = None
+        # committed through the read-only fast path, without entering the serialization graphs
+        self.read_only = False
+
+    def record(self, variable: str, entry: Union[ReadEntry, WriteEntry]):
+        """Append an operation on a variable to the transaction record."""
+        if variable in self.transaction_record:
+            self.transaction_record[variable].append(entry)
+        else:
+            self.transaction_record[variable] = [entry]
+        if entry.kind == 'w':
+            self.write_set.add(variable)
+            self.last_written[variable] = entry.value
+            if self.first_write is None or entry.tick < self.first_write:
+                self.first_write = entry.tick
+        else:
+            self.read_set.add(variable)
+
+    def writes(self) -> Iterator[Tuple[str, WriteEntry]]:
+        """The (variable, write) pairs of the record, in the order they were recorded per variable."""
+        for variable, entries in self.transaction_record.items():
+            for entry in entries:
+                if entry.kind == 'w':
+                    yield variable, entry
+
+    def get_read_write_sets(self):
+        """Returns the read set and write set of the transaction."""
+        return self.read_set, self.write_set
 
     def get_id(self):
         return self.id
 
     def get_start_time(self):
-        return self.start_time
\ No newline at end of file
+        return self.start_time
@@ -2,45 +2,431 @@
 authors: Anand Trehan, Sarthak Khandelwal
 '''
 
-from transaction_handling.transaction import Transaction
+from transaction_handling.transaction import Transaction, ReadEntry, WriteEntry, READ
+from transaction_handling.metrics import Metrics, FIRST_COMMITTER_WINS, SSI_CYCLE, AVAILABLE_COPIES, NO_AVAILABLE_SITES, \
+    CLIENT_ABORT
+from transaction_handling import events
+from transaction_handling.sinks import Sink, StdoutSink
 from sites.site_object import Site
+from sites.remote import SiteCluster, RemoteSite
+from sites.storage import create_store
+from sites.topology import Topology
+from sites.wal import WriteAheadLog
 from parser.operations import Operations
-from typing import List, Dict
-from tabulate import tabulate
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+import sys
+import threading
+import time
+from typing import List, Dict, Deque, Iterable, Set, Union
 
 class TransactionManager:
     """
     Handles all the transactions for our databases, has the core logic
     for available copies algorithm and snapshot isolation.
+    The outcome of every operation is reported as events pushed to the sink,
+    which prints them by default. Given a wal_dir, committed writes, failures and
+    recoveries are logged per site and the data and site status of an earlier
+    run are recovered from there.
+    With a catch_up_rate, recovered sites copy up to that many replicated
+    variables per operation from a current replica, see `catch_up`.
+
+    With workers > 0 the manager is thread safe, several client threads may call
+    processOperation at once. Operations of a transaction are serialized by a lock
+    per transaction, reads and commits lock the sites they touch, commits are
+    validated one at a time with the per-site serialization graphs checked on a
+    pool of worker threads, and fail, recover, dump and querystate run alone.
+    Waiting operations a recovery wakes are retried after it, under their own locks.
+    The manager lock only guards the ticker, the tables of the manager and the sink.
+    Locks are always taken in the order transaction, commit, sites by id, manager.
+
+    With processes > 0 the sites run in that many worker processes, see
+    sites.remote, and commits are prepared and then committed or aborted at all
+    sites with two phases.
+
+    With group_commit > 0 consecutive ends are collected, up to that many, and
+    validated and committed together when the batch is full or another operation
+    arrives, see `flush_commits`. Their events are reported by that operation.
+
+    A manager can be saved to a file and loaded again to continue from the same
+    point, see transaction_handling.state.
     """
     
-    def __init__(self):
+    def __init__(self, topology: Topology = None, gc_interval: int = 32, storage: str = 'object',
+                 sink: Sink = None, wal_dir: str = None, group_size: int = 32, checkpoint_interval: int = 1024,
+                 catch_up_rate: int = 0, workers: int = 0, processes: int = 0, group_commit: int = 0):
+        if group_commit and workers:
+            raise ValueError("group commit needs a single client thread, it cannot be combined with workers")
         self.transactions : Dict[str,Transaction] = {}
         self.ticker = 0 #timestamp
-        self.num_sites=10
-        self.pending_transactions: List[Operations] = []
+        self.topology = topology if topology is not None else Topology()
+        self.cluster = SiteCluster(self.topology, processes, storage) if processes > 0 else None
+        self.store = self.cluster.store if self.cluster is not None else create_store(storage, self.topology)
+        self.num_sites=self.topology.num_sites
+        # waiting operations by arrival sequence number, and the sequence numbers
+        # of the operations waiting on each site in FIFO order
+        self.pending_transactions: Dict[int, Operations] = {}
+        self.waiting_on: Dict[int, Deque[int]] = defaultdict(deque)
+        # waiting reads by (transaction, variable), a later write by the same
+        # transaction lets them read their own write on the next retry
+        self.waiting_reads: Dict[tuple, List[int]] = defaultdict(list)
+        self.runnable: List[int] = []
+        self.pending_sequence = 0
+        self.gc_interval = gc_interval
+        self.ends_since_gc = 0
+        self.reclaimed_transactions = 0
+        self.metrics = Metrics()
+        # variable -> (tick, sites) of its latest commit, for first committer wins
+        self.last_commit: Dict[str, tuple] = {}
+        # variable -> sites it was committed at since a dump last reported it there,
+        # variables in commit order
+        self.changed_variables: Dict[str, Set[int]] = {}
+        # variables committed since garbage collection last vacuumed their versions
+        # with no transaction active
+        self.unvacuumed: Set[str] = set()
+        self.sink = sink if sink is not None else StdoutSink()
+        # events of the operation being processed, per client thread
+        self._local = threading.local()
+        self.workers = workers
+        self._start_concurrency()
         self.sites: List[Site] = self.__initialise_all_sites() 
+        # availability of the sites, only changed by fail and recover: bit i-1 is set
+        # while site i is up, the ids of the sites that are up and the tick of the
+        # last fail or recover
+        self.available = (1 << self.num_sites) - 1
+        self.healthy_sites = tuple(self.topology.site_ids)
+        self.availability_changed = 0
+        self.checkpoint_interval = checkpoint_interval
+        # ends waiting to be committed together as (transaction id, tick), at most group_commit
+        self.group_commit = group_commit
+        self.commit_batch: List[tuple] = []
+        # recovered site -> replicated variables it still has to catch up on
+        self.catch_up_rate = catch_up_rate
+        self.catching_up: Dict[int, Deque[str]] = {}
+        self.logs: Dict[int, WriteAheadLog] = {}
+        # events held back until the logs of the commits before them are synced, see
+        # `sync_commits`, the number of commits among them and the sites they logged at
+        self.group_size = group_size
+        self.held_events: List["events.Event"] = []
+        self.held_commits = 0
+        self.unsynced_sites: Set[int] = set()
+        if wal_dir is not None:
+            self.logs = {site_id: WriteAheadLog(wal_dir, site_id, group_size) for site_id in self.topology.site_ids}
+            self._recover_from_logs()
+
+    def _start_concurrency(self):
+        """Create the worker threads and locks of the concurrent mode, or no-op locks without it."""
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="validate") if self.workers > 0 else None
+        self.lock = threading.RLock() if self.workers > 0 else nullcontext()
+        self.commit_lock = threading.RLock() if self.workers > 0 else nullcontext()
+        # transaction id -> [lock, number of operations holding or waiting for it]
+        self.transaction_locks: Dict[str, list] = {}
+
+    def __getstate__(self):
+        """
+        The state saved by transaction_handling.state: everything but the sink, the
+        threads, the locks and the write-ahead logs, which belong to a running manager.
+        """
+        if self.cluster is not None:
+            raise ValueError("the state of sites running in worker processes cannot be saved")
+        state = self.__dict__.copy()
+        for name in ('sink', '_local', 'pool', 'lock', 'commit_lock', 'transaction_locks', 'logs'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.sink = StdoutSink()
+        self._local = threading.local()
+        self.logs = {}
+        self.unsynced_sites = set()
+        self._start_concurrency()
 
     def __initialise_all_sites(self):
         """Create a site object for each site and store them with the manager"""
         all_sites=[]
         for i in range(1,self.num_sites+1):
-            temp=Site(True,-1,i) #all sites intialised in good health
+            if self.cluster is not None:
+                temp=RemoteSite(True,-1,i,self.cluster)
+            else:
+                temp=Site(True,-1,i,self.topology,self.store) #all sites intialised in good health
             all_sites.append(temp)
         return all_sites
+
+    def _site_id(self, raw_id: str):
+        """The id of the site a fail or recover names, or None if there is no such site."""
+        try:
+            site_id = int(raw_id)
+        except (TypeError, ValueError):
+            return None
+        return site_id if site_id in range(1, self.num_sites + 1) else None
+
+    def _update_availability(self, site_id: int, health: bool):
+        """Mirror a fail or recover of a site in the availability bitmap."""
+        if health:
+            self.available |= 1 << (site_id - 1)
+        else:
+            self.available &= ~(1 << (site_id - 1))
+        self.healthy_sites = tuple(site.site_id for site in self.sites if site.health)
+        self.availability_changed = self.ticker
+
+    def is_available(self, site_id: int):
+        """Checks if a site is up."""
+        return self.available >> (site_id - 1) & 1 == 1
+
+    def available_sites(self, variable: str):
+        """
+        Returns the sites holding a variable that are up, as a tuple shared by every
+        write routed while the availability does not change.
+        """
+        if self.topology.is_replicated(variable):
+            return self.healthy_sites
+        placement = self.topology.sites_of(variable)
+        available = tuple(site_id for site_id in placement if self.is_available(site_id))
+        return placement if len(available) == len(placement) else available
+
+    def _emit(self, event: "events.Event"):
+        """
+        Report an event of the operation being processed. While commits wait for their
+        log sync, events are held back behind them, so they are reported in order.
+        """
+        with self.lock:
+            if self.held_events:
+                self.held_events.append(event)
+                return
+            self.sink.emit(event)
+        operation_events = getattr(self._local, "events", None)
+        if operation_events is not None:
+            operation_events.append(event)
+
+    def sync_commits(self):
+        """
+        Group commit of the write-ahead logs: fsync every log the held commits wrote
+        to, once, then report the held events. Returns them.
+        """
+        with self.commit_lock:
+            for site_id in sorted(self.unsynced_sites):
+                self.logs[site_id].sync()
+            self.unsynced_sites = set()
+            with self.lock:
+                held, self.held_events, self.held_commits = self.held_events, [], 0
+                for event in held:
+                    self.sink.emit(event)
+        return held
+
+    def _site_locks(self, site_ids):
+        """Locks the given sites in order of their ids, nothing outside of the concurrent mode."""
+        if self.pool is None:
+            return nullcontext()
+        stack = ExitStack()
+        for site_id in sorted(site_ids):
+            stack.enter_context(self.sites[site_id - 1].lock)
+        return stack
+
+    def _operation_locks(self, operation: "Operations"):
+        """The locks an operation holds while it is processed in the concurrent mode."""
+        stack = ExitStack()
+        if operation.op_type in ("r", "w", "end"):
+            stack.enter_context(self._transaction_lock(operation.id))
+            if operation.op_type == "r":
+                transaction = self.transactions.get(operation.id)
+                if transaction is not None and transaction.commit_time is not None:
+                    # a waiting read of a committed transaction reindexes it at every site, see _record
+                    stack.enter_context(self._site_locks(self.topology.site_ids))
+                else:
+                    stack.enter_context(self._site_locks(self.topology.sites_of(operation.variable)))
+            elif operation.op_type == "end":
+                stack.enter_context(self.commit_lock)
+        elif operation.op_type in ("fail", "recover", "dump", "querystate"):
+            stack.enter_context(self._exclusive())
+        return stack
+
+    @contextmanager
+    def _transaction_lock(self, transaction_id: str):
+        """
+        Holds the lock of a transaction. The lock of a finished transaction is dropped
+        once no operation holds or waits for it, so all of them share one lock.
+        """
+        with self.lock:
+            entry = self.transaction_locks.setdefault(transaction_id, [threading.RLock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                transaction = self.transactions.get(transaction_id)
+                if entry[1] == 0 and (transaction is None or transaction.commit_time is not None):
+                    del self.transaction_locks[transaction_id]
+
+    def _exclusive(self):
+        """Locks everything, for the operations that run alone."""
+        stack = ExitStack()
+        stack.enter_context(self.commit_lock)
+        stack.enter_context(self._site_locks(self.topology.site_ids))
+        stack.enter_context(self.lock)
+        return stack
     
     def processOperation(self, operation: "Operations", is_pending: bool):
         """
         Process a particular valid operation. If a operation cannot execute 
-        due to available copies reason, it added to a list of pending transactions.
+        due to available copies reason, it is queued on the sites it is waiting for.
         If a pending transaction is being processed, the timestamp is not updated.
         Depending on the type of operation, respective method is invoked to handle it.
+        Returns the events of the operation, including those of the waiting operations
+        it allowed to proceed.
         """
-        if not is_pending:
+        if is_pending:
+            self._process(operation, True, self.ticker)
+            return self._local.events
+        started = time.perf_counter_ns()
+        self._local.events = []
+        self._local.retries = []
+        joins_batch = self._joins_batch(operation)
+        if self.commit_batch and not joins_batch:
+            self.flush_commits()
+        with self.lock:
             self.ticker+=1 #for each operation ticker increments by 1
+            tick = self.ticker
+        if joins_batch:
+            self.commit_batch.append((operation.id, tick))
+            if len(self.commit_batch) >= self.group_commit:
+                self.flush_commits()
+        elif self.pool is None:
+            self._process(operation, False, tick)
+        else:
+            with self._operation_locks(operation):
+                self._process(operation, False, tick)
+            self._retry_pending()
+        if self.catching_up:
+            with self._exclusive() if self.pool is not None else nullcontext():
+                self.catch_up()
+        if self.held_commits >= self.group_size:
+            # group commit: group_size commits share one sync of every log they wrote to
+            self._local.events.extend(self.sync_commits())
+        with self.lock:
+            self.metrics.record_operation(operation.op_type, time.perf_counter_ns() - started)
+        return self._local.events
+
+    def abort(self, transaction_ids):
+        """
+        Aborts the given transactions on behalf of their client, e.g. one that
+        disconnected, and drops their waiting operations, so they no longer hold
+        back garbage collection. Transactions that already finished only lose their
+        waiting operations. Returns the events.
+        """
+        self._local.events = []
+        transaction_ids = set(transaction_ids)
+        if self.commit_batch:
+            self.flush_commits()
+        with ExitStack() as stack:
+            if self.pool is not None:
+                for transaction_id in sorted(transaction_ids):
+                    stack.enter_context(self._transaction_lock(transaction_id))
+                stack.enter_context(self._exclusive())
+            with self.lock:
+                for sequence, operation in list(self.pending_transactions.items()):
+                    if operation.id in transaction_ids:
+                        del self.pending_transactions[sequence]
+                        if operation.op_type=="r":
+                            self._forget_waiting_read(operation, sequence)
+            aborted = [self.transactions[transaction_id] for transaction_id in sorted(transaction_ids)
+                       if transaction_id in self.transactions
+                       and self.transactions[transaction_id].commit_time is None]
+            for transaction in aborted:
+                self._emit(events.Aborted(transaction.id, CLIENT_ABORT))
+                self._remove_aborted(transaction)
+                with self.lock:
+                    self.transactions.pop(transaction.id)
+                    self.metrics.record_abort(CLIENT_ABORT)
+            if aborted:
+                self._count_ends(len(aborted))
+        return self._local.events
+
+    def _joins_batch(self, operation: "Operations"):
+        """
+        Checks if an operation is an end that waits in the group commit batch. Ends of
+        unknown or already committed transactions, a second end of a transaction in
+        the batch and ends while recovered sites catch up are processed right away.
+        """
+        if not self.group_commit or operation.op_type != 'end' or self.catching_up:
+            return False
+        transaction = self.transactions.get(operation.id)
+        return (transaction is not None and transaction.commit_time is None
+                and all(transaction_id != operation.id for transaction_id, _ in self.commit_batch))
+
+    def flush_commits(self):
+        """
+        Validate and commit the ends waiting in the group commit batch. The batch is
+        validated optimistically, see `_commit_batch`. If any of its transactions
+        cannot commit, the batch is undone and its ends are processed one by one,
+        so the outcome is always that of processing them in order.
+        """
+        batch, self.commit_batch = self.commit_batch, []
+        if len(batch) > 1 and self._commit_batch(batch):
+            return
+        for transaction_id, tick in batch:
+            self.end(transaction_id, tick)
+
+    def _commit_batch(self, batch: List[tuple]):
+        """
+        Commit a batch of (transaction id, tick) ends if all of them can commit,
+        returns False, with every site as before, otherwise. Available copies and
+        first committer wins are checked against the commits of the batch before
+        them, then every site validates the whole batch in one pass, each
+        transaction as if the ones before it had committed, and the writes of the
+        batch are applied with one sweep per site.
+        """
+        transactions = [self.transactions[transaction_id] for transaction_id, _ in batch]
+        written = set()
+        for transaction in transactions:
+            if self._site_down_after_write(transaction) is not None:
+                return False
+            _, write_set = transaction.get_read_write_sets()
+            if not write_set.isdisjoint(written) or self.committed_after(write_set, transaction.start_time):
+                return False
+            written.update(write_set)
+        # transactions of the batch commit after the others in it started, so the
+        # read-only fast path is decided for all of them up front
+        read_only = [not transaction.write_set and not self._needs_graphs(transaction) for transaction in transactions]
+        validated = [(transaction, tick) for transaction, (_, tick), fast in zip(transactions, batch, read_only)
+                     if not fast]
+        if validated and not self._validate_batch(validated):
+            for transaction, _ in validated:
+                self._remove_aborted(transaction)
+                transaction.commit_time = None
+            return False
+        horizon = self.snapshot_horizon(transaction.id for transaction in transactions)
+        commits = []
+        for transaction, (_, tick), fast in zip(transactions, batch, read_only):
+            transaction.read_only = fast
+            commits.append((transaction, tick, self._commit_writes(transaction, tick)))
+        self._apply_commits(commits, horizon)
+        self._count_ends(len(batch))
+        return True
+
+    def _validate_batch(self, validated: List[tuple]):
+        """Validate (transaction, commit time) pairs in order at every healthy site, True if all pass."""
+        transactions = [transaction for transaction, _ in validated]
+        ticks = [tick for _, tick in validated]
+        if self.cluster is not None:
+            results = self.cluster.validate_batch(self.healthy_sites, transactions, ticks)
+            return all(result is None for result in results)
+        for site_id in self.healthy_sites:
+            if self.sites[site_id - 1].validate_batch(transactions, ticks) is not None:
+                return False
+        return True
+
+    def _process(self, operation: "Operations", is_pending: bool, tick: int):
+        """Invoke the method handling the type of an operation, processed at tick."""
         if operation.op_type=="begin":
-            new_transaction = Transaction(operation.id,self.ticker)
+            new_transaction = Transaction(operation.id,tick)
             self.add_transaction(new_transaction,operation.id)
+        elif operation.op_type in ("r", "w") and not self.topology.sites_of(operation.variable):
+            # no site stores the variable, nothing would ever wake the operation
+            self._emit(events.InvalidOperation())
         elif operation.op_type=="r":
             #return read value if exists and updates the transaction record
             canReadOutput = self.canRead(operation.id, operation.variable)
@@ -48,30 +434,37 @@ class TransactionManager:
                 pass #everything is ok!
             elif canReadOutput==1:
                 #add to pending since we need to wait
-                self.pending_transactions.append(operation)
+                self.add_pending_operation(operation)
             else:
                 #transaction aborted
                 pass
+        elif operation.op_type=="w" and not self.store.accepts(operation.value):
+            # the storage engine could not commit the value
+            self._emit(events.InvalidOperation())
         elif operation.op_type=="w":
             # checks if write is possible and updates the transaction record
-            if self.canWrite(operation.id, operation.variable, operation.value, self.ticker):
-                pass
+            if self.canWrite(operation.id, operation.variable, operation.value, tick):
+                with self.lock:
+                    self.runnable.extend(self.waiting_reads.pop((operation.id, operation.variable), ()))
             else:
                 #add to pending since we need to wait
-                self.pending_transactions.append(operation)
+                self.add_pending_operation(operation)
         elif operation.op_type=="end":
-            self.end(operation.id, self.ticker)
+            self.end(operation.id, tick)
+        elif operation.op_type in ("fail", "recover") and self._site_id(operation.id) is None:
+            self._emit(events.InvalidOperation())
         elif operation.op_type=="fail":
-            self.fail(int(operation.id))
+            self.fail(self._site_id(operation.id))
         elif operation.op_type=="recover":
-            self.recover(int(operation.id), self.ticker-1)
+            self.recover(self._site_id(operation.id), tick-1)
         elif operation.op_type=="dump":
-            self.dump()
+            self.dump(operation.id)
         elif operation.op_type=="querystate":
-            pass
+            self.queryState(operation.id == "json")
+        elif operation.op_type=="exit":
+            self._emit(events.Bye())
         else:
-            pass
-        return
+            self._emit(events.InvalidOperation())
 
     def canRead(self,transaction_id: str, variable : str):
         """
@@ -85,49 +478,41 @@ class TransactionManager:
         the read simply waits otherwise it reads from a site and returns the value. 
         """
         if not transaction_id in self.transactions:
-            print("Transaction has already aborted %s" % transaction_id)
+            self._emit(events.AlreadyAborted(transaction_id))
             return 0
         else:
-            if variable in self.transactions[transaction_id].transaction_record.keys():
-                for operation in reversed(self.transactions[transaction_id].transaction_record[variable]):
-                    if operation[0] == 'w':
-                        print("Read successful")
-                        print(variable + ": " +operation[1])
-                        return 2
+            last_written = self.transactions[transaction_id].last_written
+            if variable in last_written:
+                self._emit(events.ReadResult(transaction_id, variable, last_written[variable]))
+                return 2
         
-        if variable in self.transactions[transaction_id].snapshot:
-            avl_site=False
-            for site_id in self.transactions[transaction_id].snapshot_sites[variable]:
-                if self.sites[site_id-1].health==True:
-                    avl_site=True
+        if self.resolve_snapshot(self.transactions[transaction_id], variable):
+            avl_site = any(self.is_available(site_id)
+                           for site_id in self.transactions[transaction_id].snapshot_sites[variable])
                 
             if not avl_site:
-                print("Waiting Transaction because of no available sites %s" % transaction_id)
+                self._emit(events.Waiting(transaction_id))
                 return 1
             
-            if variable in self.transactions[transaction_id].transaction_record:
-                self.transactions[transaction_id].transaction_record[variable].extend([["r"]])
-            else:
-                self.transactions[transaction_id].transaction_record[variable]=[["r"]]
-            #print read result
-            print("Read successful")
-            print(variable+": "+str(self.transactions[transaction_id].snapshot[variable]))
+            self._record(self.transactions[transaction_id], variable, READ)
+            #report read result
+            self._emit(events.ReadResult(transaction_id, variable, self.transactions[transaction_id].snapshot[variable]))
             return 2
         
         # if variable isn't in snapshot then we either abort in case of replicated variable or we wait 
-        if int(variable.split("x")[1])%2==1:
-            #print wait message
-            print("Waiting Transaction because of no available sites %s" % transaction_id)
+        if not self.topology.is_replicated(variable):
+            #report wait
+            self._emit(events.Waiting(transaction_id))
             return 1
         else:
-            #print abort message
-            print("Aborted Transaction because of no available sites %s" % transaction_id)
+            #report abort
+            self._emit(events.Aborted(transaction_id, NO_AVAILABLE_SITES))
             # remove aborted transaction from all sites
-            for site in self.sites:
-                #if site.health==True:
-                site.remove_aborted_transaction(self.transactions[transaction_id])
+            self._remove_aborted(self.transactions[transaction_id])
             # remove transaction from the Transaction manager
-            self.transactions.pop(transaction_id)
+            with self.lock:
+                self.transactions.pop(transaction_id)
+                self.metrics.record_abort(NO_AVAILABLE_SITES)
             return 0
 
     def canWrite(self, transaction_id: str, variable : str, value : int, tick: int):
@@ -138,31 +523,34 @@ class TransactionManager:
         transaction waits.
         """
         if not transaction_id in self.transactions:
-            print("Transaction has already aborted %s" % transaction_id)
+            self._emit(events.AlreadyAborted(transaction_id))
             return False
-        var_num = int(variable.split('x')[-1])
-        available_sites = []
-        if var_num % 2 == 1:
-            if self.sites[(var_num % 10)].health:
-                available_sites.append(1 + (var_num % 10))
-        else:
-            for site in self.sites:
-                if site.health==True:
-                    available_sites.append(1 + self.sites.index(site))
-                else:
-                    continue
-        # Print waiting message
+        available_sites = self.available_sites(variable)
+        # Report waiting
         if len(available_sites) > 0:
-            print("We can write to ", available_sites)
-            if variable in self.transactions[transaction_id].transaction_record:
-                self.transactions[transaction_id].transaction_record[variable].extend([["w", value, available_sites, tick]])
-            else:
-                self.transactions[transaction_id].transaction_record[variable]=[["w", value, available_sites, tick]]
+            self._emit(events.WriteAccepted(transaction_id, variable, available_sites))
+            self._record(self.transactions[transaction_id], variable, WriteEntry(value, available_sites, tick))
             return True
         else:
-            print("Waiting Transaction because of no available sites %s" % transaction_id)
+            self._emit(events.Waiting(transaction_id))
             return False
 
+    def _record(self, transaction: "Transaction", variable: str, entry: Union[ReadEntry, WriteEntry]):
+        """
+        Record an operation of a transaction. A waiting operation can still be recorded
+        after its transaction committed, the sites keeping the transaction then index
+        it again, and the site workers get the new read and write sets of their copy.
+        """
+        transaction.record(variable, entry)
+        if transaction.commit_time is None:
+            return
+        if self.cluster is not None:
+            self.cluster.update_sets(transaction)
+        else:
+            with self._site_locks(self.topology.site_ids):
+                for site in self.sites:
+                    site.reindex_transaction(transaction.id)
+
     def canCommit(self, transaction: "Transaction", potential_commit_time : int ):
         """
         This method checks if a commit is allowed by the following two rules:
@@ -176,41 +564,115 @@ class TransactionManager:
             the transaction manager.
         """
         canWeCommit=True
-        write_dict = self._create_write_dict(transaction)
-        for obj in write_dict:
-            for site in self.sites:
-                if site.health==True:
-                    if obj in site.data:
-                        if site.data[obj].lastWriteTime > transaction.start_time:
-                            canWeCommit=False
-                            return False
+        _, write_set = transaction.get_read_write_sets()
+        if self.committed_after(write_set, transaction.start_time):
+            canWeCommit=False
+            transaction.abort_reason = transaction.abort_reason or FIRST_COMMITTER_WINS
+            return False
+        if not write_set and not self._needs_graphs(transaction):
+            # read-only fast path, the transaction can never be part of a dangerous structure
+            transaction.read_only = True
+            return True
         # send transaction -> call update graph on all sites -> if even one fails then do not commit
-        for site in self.sites:
-            if site.health==True:
-                if not site.updateGraph(transaction,potential_commit_time):
-                    canWeCommit=False
-                    return False
+        if self.cluster is not None:
+            # first phase of the commit, prepared at every site in parallel
+            results = self.cluster.prepare(self.healthy_sites, transaction, potential_commit_time)
+            failed = [self.sites[site_id - 1] for site_id, result in zip(self.healthy_sites, results) if not result]
+        elif self.pool is not None and len(self.healthy_sites) > 1:
+            # every site is checked, the first failing one in site order reports the abort
+            sites = [self.sites[site_id - 1] for site_id in self.healthy_sites]
+            results = list(self.pool.map(lambda site: self._update_graph(site, transaction, potential_commit_time),
+                                         sites))
+            failed = [site for site, result in zip(sites, results) if not result]
+        else:
+            failed = []
+            for site_id in self.healthy_sites:
+                site = self.sites[site_id - 1]
+                with self._site_locks((site_id,)):
+                    valid = site.updateGraph(transaction,potential_commit_time)
+                if not valid:
+                    failed.append(site)
+                    break
+        if failed:
+            self._emit(events.DangerousStructure(transaction.id, failed[0].site_id))
+            canWeCommit=False
+            transaction.abort_reason = transaction.abort_reason or SSI_CYCLE
+            return False
         if canWeCommit : 
             return True
         else:
             return False
     
+    def _needs_graphs(self, transaction: "Transaction"):
+        """
+        Checks if a transaction without writes has to be validated and kept in the
+        serialization graphs. Its only possible edges into it are wr edges from
+        transactions that committed before it started, it only gets outgoing edges
+        after its commit. Without such an edge at any site it never is on a cycle,
+        so it commits without entering ssi_info and adds nothing to later
+        validations. A waiting write could still be recorded after the commit, so
+        a transaction with one is validated as usual.
+        """
+        with self.lock:
+            if any(operation.id == transaction.id and operation.op_type == 'w'
+                   for operation in self.pending_transactions.values()):
+                return True
+        if self.cluster is not None:
+            return self.cluster.has_earlier_writer(self.healthy_sites, transaction)
+        for site_id in self.healthy_sites:
+            site = self.sites[site_id - 1]
+            with site.lock:
+                if site.has_earlier_writer(transaction):
+                    return True
+        return False
+
+    def _update_graph(self, site: "Site", transaction: "Transaction", tick: int):
+        """Validate a commit at one site, on a worker thread of the concurrent mode."""
+        with site.lock:
+            return site.updateGraph(transaction, tick)
+
+    def committed_after(self, variables, tick: int):
+        """
+        Checks if any of the variables has a commit after tick at a healthy site, using
+        the latest commit of each variable. Only when every site of a recent commit is
+        down, older commits may still matter and the healthy sites are looked up in the store.
+        """
+        for variable in variables:
+            last_commit = self.last_commit.get(variable)
+            if last_commit is None or last_commit[0] <= tick:
+                continue
+            for site_id in last_commit[1]:
+                if self.is_available(site_id):
+                    return True
+            if self.store.any_write_after(self.healthy_sites, [variable], tick):
+                return True
+        return False
+
     def canCommitAC(self, transaction : Transaction):
         """
         This method checks if a commit is allowed by the available copies rule.
         If the transaction has written to a site, which later failed then the transaction
-        can no longer commit. 
-        """
-        for var in transaction.transaction_record.keys():
-            for operation in transaction.transaction_record[var]:
-                if operation[0] == 'w':
-                    for site_id in operation[2]:
-                        site : Site = self.sites[site_id - 1]
-                        if (site.last_down_time > operation[3]) or site.health==False:
-                            print("Site %s was down after %s wrote to it" % (str(site.site_id), transaction.id))
-                            return False 
+        can no longer commit. Writes are only routed to sites that are up, so if no
+        site failed or recovered since the first write there is nothing to check.
+        """
+        site_id = self._site_down_after_write(transaction)
+        if site_id is not None:
+            self._emit(events.SiteDownAfterWrite(transaction.id, site_id))
+            transaction.abort_reason = AVAILABLE_COPIES
+            return False 
         return True
 
+    def _site_down_after_write(self, transaction : Transaction):
+        """Returns the first site a transaction wrote to that failed since, None if there is none."""
+        if transaction.first_write is None or self.availability_changed < transaction.first_write:
+            return None
+        for _, write in transaction.writes():
+            for site_id in write.sites:
+                site : Site = self.sites[site_id - 1]
+                if (site.last_down_time > write.tick) or not self.is_available(site_id):
+                    return site_id
+        return None
+
 
     def end(self, transaction_id : str, timestamp : int):
         """
@@ -222,76 +684,316 @@ class TransactionManager:
         site's serialization graphs. 
         """
         if not transaction_id in self.transactions:
-            print("Transaction has already aborted %s" % transaction_id)
+            self._emit(events.AlreadyAborted(transaction_id))
             return False
         # if cancommit gives us true then call site.write else abort transaction
         canWeEndAC = self.canCommitAC(self.transactions[transaction_id])
         
         canWeEndSSI = self.canCommit(self.transactions[transaction_id],timestamp)
-        if canWeEndAC and canWeEndSSI:
+        with self._site_locks(self.topology.site_ids):
+            self._finish(transaction_id, timestamp, canWeEndAC and canWeEndSSI)
+        return
+
+    def _finish(self, transaction_id : str, timestamp : int, commit : bool):
+        """Apply the writes of a transaction that can commit, or abort it."""
+        if commit:
             transaction = self.transactions[transaction_id]
-            for var in transaction.transaction_record.keys():
-                for operation in transaction.transaction_record[var]:
-                    if operation[0] == 'w':
-                        for site_id in operation[2]:
-                            site : Site = self.sites[site_id - 1]
-                            site.write_data(var, operation[1], timestamp)
-            print("Transaction committed %s" % transaction_id)
-            # update commit time
-            self.transactions[transaction_id].commit_time=timestamp
-            #if there are no other active transactions besides the committed one then this transaction can be removed from all sites
-            if any(key!=transaction_id for key in self.transactions):
-                #dont do anything
-                pass
-            else:
-                #delete from all sites
-                for site in self.sites:
-                    #if site.health==True:
-                    site.remove_aborted_transaction(self.transactions[transaction_id])
-                #remove transaction from transaction manager
-                self.transactions.pop(transaction_id)
+            horizon = self.snapshot_horizon((transaction_id,))
+            self._apply_commits([(transaction, timestamp, self._commit_writes(transaction, timestamp))], horizon)
         else:
             #abort transaction
-            print("Aborted Transaction because it cannot commit %s" % transaction_id) 
+            transaction = self.transactions[transaction_id]
+            self._emit(events.Aborted(transaction_id, transaction.abort_reason or SSI_CYCLE))
             #remove all references to aborted transactions from the SSI graph at each site
-            for site in self.sites:
-                #if site.health==True:
-                site.remove_aborted_transaction(self.transactions[transaction_id])
+            self._remove_aborted(transaction)
             #remove transaction from transaction manager
-            self.transactions.pop(transaction_id)
-        return
+            with self.lock:
+                self.transactions.pop(transaction_id)
+                self.metrics.record_abort(transaction.abort_reason or SSI_CYCLE)
+        self._count_ends(1)
+
+    def _commit_writes(self, transaction: "Transaction", timestamp: int):
+        """
+        Returns the writes of a committing transaction by site and records its
+        commit as the latest one of every variable it wrote. Copies made current by
+        catch-up at the sites the commit skips are no longer current, the sites
+        that are up catch up on them again.
+        """
+        writes_by_site = defaultdict(list)
+        written_sites = defaultdict(set)
+        for var, write in transaction.writes():
+            for site_id in write.sites:
+                writes_by_site[site_id].append((var, write.value))
+            written_sites[var].update(write.sites)
+        for var, sites in written_sites.items():
+            if sites:
+                self.last_commit[var] = (timestamp, tuple(sorted(sites)))
+                self.changed_variables.setdefault(var, set()).update(sites)
+                self.unvacuumed.add(var)
+                for site_id in self.topology.sites_of(var):
+                    if site_id not in sites and self.sites[site_id - 1].mark_stale(var, timestamp) \
+                            and self.catch_up_rate > 0 and self.sites[site_id - 1].health:
+                        self.catching_up.setdefault(site_id, deque()).append(var)
+        return writes_by_site
+
+    def _apply_commits(self, commits: List[tuple], horizon: int):
+        """
+        Apply the writes of the given (transaction, commit time, writes by site)
+        commits, in order, with one sweep per site, then log and report them. Logged
+        commits are reported once their logs are synced, see `sync_commits`.
+        """
+        if self.cluster is not None:
+            # second phase of the commit
+            self.cluster.commit(self.healthy_sites, [(transaction.id, timestamp, writes_by_site)
+                                                     for transaction, timestamp, writes_by_site in commits], horizon)
+        else:
+            site_writes = defaultdict(list)
+            for _, timestamp, writes_by_site in commits:
+                for site_id, writes in writes_by_site.items():
+                    site_writes[site_id].extend((var, value, timestamp) for var, value in writes)
+            for site_id, writes in site_writes.items():
+                site : Site = self.sites[site_id - 1]
+                for var, value, timestamp in writes:
+                    site.write_data(var, value, timestamp, horizon)
+        for transaction, timestamp, writes_by_site in commits:
+            if self.logs and writes_by_site:
+                for site_id, writes in writes_by_site.items():
+                    self._log_commit(site_id, timestamp, writes)
+                    self.unsynced_sites.add(site_id)
+            # update commit time
+            transaction.commit_time = timestamp
+            committed = events.Committed(transaction.id, timestamp)
+            with self.lock:
+                if self.logs and writes_by_site:
+                    # reported once the logs are synced
+                    self.held_events.append(committed)
+                    self.held_commits += 1
+                    committed = None
+                self.metrics.record_commit(transaction.read_only)
+            if committed is not None:
+                self._emit(committed)
+
+    def _count_ends(self, ends: int):
+        """Collect garbage every gc_interval ends, or once no transaction is active."""
+        self.ends_since_gc += ends
+        if self.ends_since_gc >= self.gc_interval or self.low_watermark() is None:
+            self.collect_garbage()
+
+    def _remove_aborted(self, transaction: "Transaction"):
+        """Remove an aborted transaction from the ssi_info and graphs of every site."""
+        if self.cluster is not None:
+            # only sites that are up know about it, a failure clears the graph
+            self.cluster.abort(self.healthy_sites, transaction.id)
+            return
+        for site in self.sites:
+            site.remove_aborted_transaction(transaction)
+
+    def _log_commit(self, site_id: int, tick: int, writes: list):
+        """Log the writes of a commit at a site, checkpointing the site every checkpoint_interval commits."""
+        log = self.logs[site_id]
+        log.append(tick, writes)
+        if log.records_since_checkpoint >= self.checkpoint_interval:
+            log.checkpoint(tick, self._site_cells(site_id))
+
+    def _site_cells(self, site_id: int):
+        """The variables of a site written since the start, as variable -> [value, last write time]."""
+        cells = {}
+        for var in self.topology.variables_at(site_id):
+            last_write_time = self.store.last_write_time(site_id, var)
+            if last_write_time > 0:
+                cells[var] = [self.store.value(site_id, var), last_write_time]
+        return cells
+
+    def _recover_from_logs(self):
+        """
+        Loads the data committed by an earlier run from the checkpoint and the log of
+        every site, and continues the ticker after the last recovered commit, failure
+        or recovery. Sites come back down or up as they were last logged, so replicas
+        that missed commits while down are not readable until committed again.
+        """
+        for site_id, log in self.logs.items():
+            checkpoint_tick, cells, records = log.recover()
+            recovered = [(tick, [(var, value)]) for var, (value, tick) in cells.items()]
+            recovered.extend(records)
+            for tick, writes in recovered:
+                for var, value in writes:
+                    self.store.write(site_id, var, value, tick)
+                    last_commit = self.last_commit.get(var)
+                    if last_commit is None or last_commit[0] < tick:
+                        self.last_commit[var] = (tick, (site_id,))
+                    elif last_commit[0] == tick and site_id not in last_commit[1]:
+                        self.last_commit[var] = (tick, tuple(sorted(last_commit[1] + (site_id,))))
+                self.ticker = max(self.ticker, tick)
+            self.ticker = max(self.ticker, checkpoint_tick, log.status[2])
+        for site_id, log in self.logs.items():
+            health, last_down_time, tick = log.status
+            site = self.sites[site_id - 1]
+            if not health:
+                site.last_down_time = last_down_time
+                site.failSite(tick)
+                self._update_availability(site_id, False)
+            elif last_down_time != site.last_down_time:
+                site.recoverSite(last_down_time, tick)
+
+    def close(self):
+        """
+        Commit the waiting ends, make every logged commit durable, flush the output
+        and stop the worker threads.
+        """
+        self.flush_commits()
+        self.sync_commits()
+        for log in self.logs.values():
+            log.close()
+        self.sink.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.cluster is not None:
+            self.cluster.close()
+
+    def low_watermark(self):
+        """
+        Returns the start time of the oldest active transaction, or None when no
+        transaction is active.
+        """
+        with self.lock:
+            return min((transaction.start_time for transaction in self.transactions.values()
+                        if transaction.commit_time is None), default=None)
+
+    def collect_garbage(self):
+        """
+        Reclaims committed transactions that can no longer take part in a dangerous
+        structure and returns how many were dropped. A transaction that committed
+        before the oldest active transaction started only gains outgoing edges from
+        now on, so it can only close a future cycle if it is reachable from a
+        transaction that committed after that point. Everything else is removed
+        from the manager, the ssi_info of every site and the serialization graphs.
+        Versions of the variables committed since then that no active snapshot can
+        see are vacuumed as well.
+        """
+        self.ends_since_gc = 0
+        watermark = self.low_watermark()
+        with self.lock:
+            committed = [transaction for transaction in self.transactions.values()
+                         if transaction.commit_time is not None]
+        if watermark is None:
+            reclaimable = {transaction.id for transaction in committed}
+        else:
+            recent = [transaction.id for transaction in committed if transaction.commit_time >= watermark]
+            retained = set()
+            for site in self.sites:
+                retained.update(site.reachable_from(recent))
+            reclaimable = {transaction.id for transaction in committed
+                           if transaction.commit_time < watermark and transaction.id not in retained}
+        if reclaimable:
+            for site in self.sites:
+                site.remove_committed_transactions(reclaimable)
+            with self.lock:
+                for transaction_id in reclaimable:
+                    self.transactions.pop(transaction_id)
+        self.reclaimed_transactions += len(reclaimable)
+        if self.unvacuumed:
+            # sites that are down receive no commits, they are vacuumed by the next one after recovery
+            self.store.vacuum(self.healthy_sites, self.unvacuumed, self.snapshot_horizon())
+            if watermark is None:
+                # nothing older than the current versions is left to vacuum
+                self.unvacuumed.clear()
+        return len(reclaimable)
 
-    def dump(self):
+    def dump(self, options: str = None):
         """
-        Prints the values of each variable at every site. Can be used at any point
-        after any command. The table is arranged into proper columns and rows.
+        Reports the values of each variable at every site. Can be used at any point
+        after any command. Printed, the table is arranged into proper columns and rows.
         To view the structure nicely, slightly reduce the font size of your terminal 
         so that it fits in one page.
+
+        options is a comma separated list of
+            grid, csv or jsonl: the format, grid by default. csv and jsonl are streamed
+                one site at a time instead of building the whole table
+            sites=a-b or sites=a: only these sites
+            vars=xa-xb or vars=xa: only these variables
+            changed: only the values committed since a dump last reported them
+        A dump forgets the changes of the variables at the sites it reported, those
+        filtered out stay changed.
         """
-        table = []
-        variables = [f"x{i}" for i in range(1, 21)]  # x1 to x20
-        site_list = []
-        for site in self.sites:
-            site_list.append(site.data)
-        for i, site in enumerate(site_list, start=1):  # For each site
-            row = [f"S{i}"]  # Start with site name
-            for var in variables:
-                # Append value or '*' if the key is missing
-                if var in site:
-                    row.append(site[var].value)
+        parsed = self._dump_options(options)
+        if parsed is None:
+            self._emit(events.InvalidOperation())
+            return
+        dump_format, site_ids, variables, changed = parsed
+        first, last = variables
+        index = self.topology.index
+        if changed:
+            # only look at what was committed since a dump last reported it
+            selected = set(site_ids)
+            variables = sorted((var for var, sites in self.changed_variables.items()
+                                if first <= index[var] < last and not sites.isdisjoint(selected)),
+                               key=index.__getitem__)
+            changed_sites = {var: self.changed_variables[var] & selected for var in variables}
+        else:
+            variables = self.topology.variables[first:last]
+        self._mark_reported(site_ids, variables)
+        if dump_format == 'grid':
+            self._emit(events.Dump(site_ids, variables, self.store.table(site_ids, variables)))
+            return
+        if dump_format == 'csv':
+            self._emit(events.DumpHeader())
+        for site_id in site_ids:
+            if changed:
+                cells = [(var, self.store.value(site_id, var)) for var in variables if site_id in changed_sites[var]]
+            else:
+                row = self.store.table([site_id], variables)[0]
+                cells = [(var, value) for var, value in zip(variables, row) if value is not None]
+            if cells:
+                self._emit(events.DumpRow(site_id, cells, dump_format))
+
+    def _mark_reported(self, site_ids, variables):
+        """Forget the changes of the variables at the sites a dump reported."""
+        for var in set(variables).intersection(self.changed_variables):
+            sites = self.changed_variables[var]
+            sites.difference_update(site_ids)
+            if not sites:
+                del self.changed_variables[var]
+
+    def _dump_options(self, options: str):
+        """
+        Parses the options of a dump into (format, site ids, (first, last) variable
+        index range, changed), or None if they are not valid.
+        """
+        dump_format, changed = 'grid', False
+        site_ids, variables = self.topology.site_ids, (0, len(self.topology.variables))
+        for option in (options.split(',') if options else ()):
+            name, _, bounds = option.partition('=')
+            if name in events.DUMP_FORMATS and not bounds:
+                dump_format = name
+            elif name == 'changed' and not bounds:
+                changed = True
+            elif name in ('sites', 'vars') and bounds:
+                prefix = 'x' if name == 'vars' else ''
+                first, _, last = bounds.partition('-')
+                last = last or first
+                if not first.startswith(prefix) or not last.startswith(prefix) \
+                        or not first[len(prefix):].isdigit() or not last[len(prefix):].isdigit():
+                    return None
+                first, last = int(first[len(prefix):]), int(last[len(prefix):])
+                if name == 'sites':
+                    site_ids = [site_id for site_id in self.topology.site_ids if first <= site_id <= last]
                 else:
-                    row.append('*')
-                # row.append(site.get(var, '*').value)
-            table.append(row)
-        header = [""] + variables
-        print(tabulate(table, headers=header, tablefmt="grid"))
+                    variables = (max(first - 1, 0), min(last, len(self.topology.variables)))
+            else:
+                return None
+        return dump_format, site_ids, variables, changed
 
     def fail(self, site_id : int):
         """
         Marks a site as failed.
         """
-        self.sites[site_id-1].failSite()
-        print("Site "+str(site_id)+" failed")
+        self.sites[site_id-1].failSite(self.ticker)
+        self._update_availability(site_id, False)
+        if self.logs:
+            self.logs[site_id].append_status(self.ticker, False, self.sites[site_id-1].last_down_time)
+        self.catching_up.pop(site_id, None)
+        self.sites[site_id-1].vacuum(self.snapshot_horizon())
+        self._emit(events.SiteFailed(site_id))
         return
 
     def recover(self, site_id : int, last_down_time : int):
@@ -300,91 +1002,228 @@ class TransactionManager:
         recovers, we go and check if there are any pending transactions that
         can now proceed. 
         """
-        self.sites[site_id-1].recoverSite(last_down_time)
-        print("Site "+str(site_id)+" recovered")
-        # add non replicated variables back to all snapshots 
-        for var in self.sites[site_id-1].data.keys():
-            var_num = int(var.split('x')[-1])
-            if var_num%2==1:
-                for transaction_id in self.transactions.keys():
-                    if var not in self.transactions[transaction_id].snapshot.keys():
-                        self.transactions[transaction_id].snapshot.update({var:self.sites[site_id-1].data[var].value})
-                        self.transactions[transaction_id].snapshot_sites[var]=[site_id]
-                        if site_id not in self.transactions[transaction_id].snapshot_sites[var]:
-                            self.transactions[transaction_id].snapshot_sites[var].extend([site_id])
+        self.sites[site_id-1].recoverSite(last_down_time, self.ticker)
+        self._update_availability(site_id, True)
+        if self.logs:
+            self.logs[site_id].append_status(self.ticker, True, last_down_time)
+        self.sites[site_id-1].vacuum(self.snapshot_horizon())
+        self._emit(events.SiteRecovered(site_id))
+        if self.catch_up_rate > 0:
+            self.catching_up[site_id] = deque(var for var in self.topology.variables_at(site_id)
+                                              if self.topology.is_replicated(var))
+        # non replicated variables of the site become readable again for all snapshots,
+        # see resolve_snapshot
         #handle pending
-        self.handle_pending_transactions()
+        self.handle_pending_transactions(site_id)
         return
 
-    def queryState(self):
-        # TODO
-        pass
+    def catch_up(self):
+        """
+        Copies the current committed version of up to catch_up_rate replicated variables
+        from a current replica into the recovered sites, marking each variable readable
+        for snapshots taken afterwards. Variables committed at the site since it
+        recovered are current already, variables without a current replica to copy
+        from are retried later.
+        """
+        budget = self.catch_up_rate
+        horizon = self.snapshot_horizon()
+        for site_id in list(self.catching_up):
+            site = self.sites[site_id - 1]
+            queue = self.catching_up[site_id]
+            retry = []
+            while budget > 0 and queue:
+                var = queue.popleft()
+                budget -= 1
+                if self.store.last_write_time(site_id, var) > site.last_down_time:
+                    continue
+                source_id = self._current_replica(var, site_id)
+                if source_id is None:
+                    retry.append(var)
+                    continue
+                last_write_time = self.store.last_write_time(source_id, var)
+                if self.store.last_write_time(site_id, var) != last_write_time:
+                    value = self.store.value(source_id, var)
+                    site.write_data(var, value, last_write_time, horizon)
+                    if self.logs:
+                        self._log_commit(site_id, last_write_time, [(var, value)])
+                site.mark_caught_up(var, self.ticker)
+            queue.extend(retry)
+            if not queue:
+                del self.catching_up[site_id]
+            if budget == 0:
+                break
+
+    def _current_replica(self, variable: str, exclude: int):
+        """A site that is up and holds the latest committed version of a replicated variable."""
+        for site_id in self.healthy_sites:
+            site = self.sites[site_id - 1]
+            if site_id == exclude:
+                continue
+            if self.store.last_write_time(site_id, variable) > site.last_down_time \
+                    or site.caught_up_between(variable, site.last_down_time, self.ticker + 1):
+                return site_id
+        return None
+
+    def queryState(self, as_json: bool = False):
+        """
+        Reports the metrics of the database: operation counts and latencies,
+        commits, aborts by reason and the current size of the internal state.
+        Returns them as a dictionary as well.
+        """
+        state = self.metrics.to_dict()
+        state["gauges"] = self.gauges()
+        self._emit(events.QueryState(state, as_json))
+        return state
+
+    def gauges(self):
+        """Current size of the state kept by the manager and the sites."""
+        active = sum(1 for transaction in self.transactions.values() if transaction.commit_time is None)
+        snapshot_bytes = 0
+        for transaction in self.transactions.values():
+            snapshot_bytes += sys.getsizeof(transaction.snapshot) + sys.getsizeof(transaction.snapshot_sites)
+            snapshot_bytes += sum(sys.getsizeof(value) for value in transaction.snapshot.values())
+            snapshot_bytes += sum(sys.getsizeof(sites) for sites in transaction.snapshot_sites.values())
+        return {
+            "active_transactions": active,
+            "retained_transactions": len(self.transactions) - active,
+            "pending_operations": len(self.pending_transactions),
+            "reclaimed_transactions": self.reclaimed_transactions,
+            "catch_up_variables": sum(len(queue) for queue in self.catching_up.values()),
+            "snapshot_bytes": snapshot_bytes,
+            "sites": {site.site_id: dict(health=site.health, **site.gauges()) for site in self.sites},
+        }
     
     def add_transaction(self, transaction: "Transaction",T_id: str):
         """
-        Add a new transaction to the transaction manager
+        Add a new transaction to the transaction manager. The transaction only
+        records its start time, its snapshot is resolved lazily on every first
+        read of a variable, see `resolve_snapshot`.
         """
-        self.update_initial_snapshot(transaction)
-        self.transactions[T_id]=transaction
+        with self.lock:
+            self.transactions[T_id]=transaction
         return
+
+    def snapshot_horizon(self, committing: Iterable[str] = ()):
+        """
+        Returns the oldest tick an active transaction, other than the committing
+        ones, may still read a snapshot at. Versions and failure history older than
+        that can be vacuumed.
+        """
+        committing = set(committing)
+        with self.lock:
+            return min((transaction.start_time for transaction in self.transactions.values()
+                        if transaction.commit_time is None and transaction.id not in committing),
+                       default=self.ticker)
     
-    def update_initial_snapshot(self, transaction: "Transaction"):
+    def resolve_snapshot(self, transaction: "Transaction", variable: str):
         """
-        Creates a snapshot of the database when a new transaction comes. This
-        transaction will use this snapshot for all it's reads. It captures the
-        current state of the database when the transaction started.
+        Resolves the value of a variable in the snapshot of the database taken when
+        the transaction started, using the version chain of the data and the
+        failure history of the sites. Returns False if the variable is not part of
+        the snapshot. Resolved values are cached in the transaction's snapshot.
+
+        Non replicated variables are read from their site if it was up when the
+        transaction started, otherwise as of the first time the site recovered
+        after that. Replicated variables are read from the last site that was up
+        when the transaction started and had a commit to the variable after it
+        was last down, or was made current by catch-up before the transaction started.
         """
-        snapshot = {}
-        snapshot_sites = {}
-        for site in self.sites:
-            if site.health==True:
-                for variable in site.data.keys():
-                    var = site.data[variable]
-                    # for each non replicated site, if variable exists and site is up we directly add to snapshot
-                    if int(variable.split("x")[1])%2==1:
-                        snapshot.update({var.variableName:var.value})
-                        if var in snapshot_sites:   
-                            snapshot_sites[var.variableName].extend([site.site_id])
-                        else:
-                            snapshot_sites[var.variableName]=[site.site_id]
-                    # for each replicated site check if transaction started after the last commit time of variable and 
-                    # if the site was last down at a time before the variable's last commit time.
-                    else:
-                        if var.lastWriteTime > site.last_down_time and var.lastWriteTime < transaction.get_start_time() : 
-                            snapshot.update({var.variableName:var.value})
-                            if var in snapshot_sites:   
-                                snapshot_sites[var.variableName].extend([site.site_id])
-                            else:
-                                snapshot_sites[var.variableName]=[site.site_id]
-                        else:
-                            continue
-            else:
-                continue
-        transaction.snapshot=snapshot  
-        transaction.snapshot_sites=snapshot_sites   
-        return
+        if variable in transaction.snapshot:
+            return True
+        start_time = transaction.get_start_time()
+        site_ids = self.topology.sites_of(variable)
+        if not site_ids:
+            return False
+        if not self.topology.is_replicated(variable):
+            site = self.sites[site_ids[0] - 1]
+            health, _ = site.state_at(start_time)
+            read_time = start_time if health else site.first_recovery_after(start_time)
+            if read_time is None:
+                return False
+            transaction.snapshot[variable] = self.store.value_at(site.site_id, variable, read_time)
+            transaction.snapshot_sites[variable] = [site.site_id]
+            return True
+        snapshot_site = None
+        for site_id in site_ids:
+            site = self.sites[site_id - 1]
+            health, last_down_time = site.state_at(start_time)
+            if health:
+                last_write_time = self.store.last_write_time_at(site_id, variable, start_time)
+                if (last_write_time > last_down_time and last_write_time < start_time) \
+                        or site.caught_up_between(variable, last_down_time, start_time):
+                    snapshot_site = site
+        if snapshot_site is None:
+            return False
+        transaction.snapshot[variable] = self.store.value_at(snapshot_site.site_id, variable, start_time)
+        transaction.snapshot_sites[variable] = [snapshot_site.site_id]
+        return True
     
-    def handle_pending_transactions(self):
+    def blocking_sites(self, operation: "Operations"):
         """
-        Handles the processing of pending transaction, triggered when a site recovers
+        Returns the sites a waiting read or write needs to come back before it can
+        proceed. A read of a variable in the transaction's snapshot waits for the
+        site it was read from, any other operation for any site holding the variable.
         """
-        l = len(self.pending_transactions)
-        i = 0
-        while i < l:
-            self.processOperation(self.pending_transactions[0],True)
-            self.pending_transactions.pop(0)
-            i+=1
+        transaction = self.transactions.get(operation.id)
+        if operation.op_type=="r" and transaction is not None \
+                and operation.variable in transaction.snapshot_sites:
+            return transaction.snapshot_sites[operation.variable]
+        return self.topology.sites_of(operation.variable)
+
+    def add_pending_operation(self, operation: "Operations"):
+        """Queue a waiting operation on every site that can unblock it."""
+        blocking_sites = self.blocking_sites(operation)
+        with self.lock:
+            self.pending_sequence += 1
+            self.pending_transactions[self.pending_sequence] = operation
+            for site_id in blocking_sites:
+                self.waiting_on[site_id].append(self.pending_sequence)
+            if operation.op_type=="r":
+                self.waiting_reads[(operation.id, operation.variable)].append(self.pending_sequence)
+        return
+
+    def handle_pending_transactions(self, site_id: int):
+        """
+        Handles the processing of pending transaction, triggered when a site recovers.
+        Only the operations waiting on the recovered site, and reads whose transaction
+        has since written the variable itself, are retried in the order they arrived.
+        Operations that still cannot proceed are queued again. In the concurrent mode
+        they are retried once the recovery released its locks, see `_retry_pending`.
+        """
+        woken = set(self.waiting_on.pop(site_id, ()))
+        woken.update(self.runnable)
+        self.runnable = []
+        # operations queued on several sites may already have been retried
+        for sequence in sorted(woken):
+            operation = self.pending_transactions.pop(sequence, None)
+            if operation is None:
+                continue
+            if operation.op_type=="r":
+                self._forget_waiting_read(operation, sequence)
+            if self.pool is not None:
+                self._local.retries.append(operation)
+            else:
+                self.processOperation(operation, True)
         return
 
-    def _create_write_dict(self, transaction):
+    def _retry_pending(self):
         """
-        Creates a dictionary of all the writes done by a particular transaction
+        Retry the waiting operations a recovery woke in the concurrent mode, each under
+        the locks of its own transaction and sites, which cannot be taken while the
+        recovery holds the commit, site and manager locks.
         """
-        write_dict = {}
-        transaction_record = transaction.transaction_record
-        for key in transaction_record.keys():
-            for operations in transaction_record[key]:
-                if operations[0] == "w":
-                    write_dict.update({key:operations[1]})
-        return write_dict
+        while self._local.retries:
+            # retries may queue further ones
+            retries, self._local.retries = self._local.retries, []
+            for operation in retries:
+                with self._operation_locks(operation):
+                    self._process(operation, True, self.ticker)
 
+    def _forget_waiting_read(self, operation: "Operations", sequence: int):
+        """Drop a read that is being retried from the waiting reads index."""
+        key = (operation.id, operation.variable)
+        sequences = self.waiting_reads.get(key)
+        if sequences is not None and sequence in sequences:
+            sequences.remove(sequence)
+            if not sequences:
+                del self.waiting_reads[key]